@@ -11,179 +11,1410 @@
 #   the errors that often occur. Produces  gff files as output.                                              #
 ##############################################################################################################
 
+import argparse
+import array
+import collections
+import cProfile
+import fnmatch
+import gzip
+import hashlib
+import itertools
+import json
+import mmap
+import multiprocessing
+import os
+import pstats
+import re
+import resource
+import shutil
+import struct
 import subprocess
 import sys
+import threading
 import timeit
+import traceback
+import urllib
+import zlib
 
-def main():
+#directories of the current run, set by runTransfer (and by batchQuery in the process of each query of a batch)
+ratt_dir = None
+scratch_dir = None
+
+#the command line is a thin wrapper around runTransfer, which transfer() also uses
+def main(argv=None):
     startTime = timeit.default_timer()
-    if (len(sys.argv) != 6):
-        sys.stderr.write('<RATTwithGFF.py>USAGE ERROR: SetupEmbls.py <reference gff> <reference fasta> <query fasta> <runID> <Transfer type>\n')
+    args = parseArgs(sys.argv[1:] if argv is None else argv)
+    result = runTransfer(args)
+    if result is None:
         return 0
-
-    gffFileName = sys.argv[1]
-    fastaFileName = sys.argv[2]
-    queryFastaFile = sys.argv[3]
-    sampleID = sys.argv[4]
-    rattType = sys.argv[5]
+    if result["runIDs"]:
+        printTransferStats() #in batch mode also the stats of the queries that were transferred when others failed
+    if result["complete"]:
+        elapsedTime = (timeit.default_timer() - startTime)/60
+        print("\n<RATTwithGFF.py> COMPLETE in "+format(elapsedTime,'.2f')+" minutes")
+
+#transfers the annotations of a reference to a query from python, without going through the command line
+#options are the command line options by the names parseArgs gives them, e.g. jobs=4, seqret=True or noContigGffs=True,
+#and have the same defaults; the results are written to <runID>_RATT in the working directory as on the command line
+#with noContigGffs=True the contig gffs are not written, the results are only written to the genomic gff
+#only the reference features counted by the split are handed to the transfer stats in memory, the rest goes through files
+#returns the result of runTransfer with the features of the genomic gff as GffFeatures (unless features is False),
+#or None if the transfer failed, the reason is printed to stderr
+#the returned features are all held in memory, with features=False the memory stays bounded as on the command line
+#raises TypeError for an option that does not exist and ValueError for an invalid value, input file or transfer type
+#ratt_dir and scratch_dir are set back to their values from before the call when it returns
+def transfer(referenceGff, referenceFasta, queryFasta, transferType, runID="RATT", features=True, **options):
+    args = parseArgs([referenceGff, referenceFasta, queryFasta, runID, transferType])
+    for name, value in options.iteritems():
+        if name in ("gff", "fasta", "queryFasta", "sampleID", "rattType") or not hasattr(args, name):
+            raise TypeError("transfer() got an unexpected option '"+name+"'")
+        setattr(args, name, value)
+    if args.batch:
+        raise ValueError("transfer() transfers to a single query, call it once for each query of a batch")
+    error = checkOptions(args)
+    if error is None:
+        error = inputError(referenceGff, referenceFasta, [queryFasta], transferType)
+    if error is not None:
+        raise ValueError(error)
+    global ratt_dir
+    global scratch_dir
+    previous = ratt_dir, scratch_dir
+    try:
+        return runTransfer(args, [] if features else None)
+    finally:
+        ratt_dir, scratch_dir = previous
+
+# [rattDir]:the RATT directory of the run [genomicGff]:path of genomic.final.gff
+# [features]:GffFeatures of the genomic gff, only when runTransfer was given a list for them
+# [stats]:the transfer stats made by makeTransferStats, None in batch mode
+# [runIDs]:run-IDs of the queries that were transferred [complete]:True if every query was transferred
+#runs the whole pipeline for the parsed arguments: splits the reference, converts it to embl and transfers it to the
+#query, or to every query of a batch
+#the features of the genomic gff are added to records unless it is None
+#returns None if the inputs or the reference could not be prepared
+#called by main and transfer
+def runTransfer(args, records=None):
+    telemetry = newTelemetry(args.profile) #usage of each stage, written to the RATT directory
+    if args.profile and args.jobs > 1:
+        print "\n<RATTwithGFF.py> --profile converts the contigs one at a time so that the profiles include them"
+        args.jobs = 1
+        args.toolJobs = 1
+
+    gffFileName = args.gff
+    fastaFileName = args.fasta
+    queryFastaFile = args.queryFasta
+    sampleID = args.sampleID
+    rattType = args.rattType
     contigs = []
 
-    if (validArgs(gffFileName, fastaFileName, queryFastaFile, rattType)):
-        
-        #ensures end of line is LF not CRLF
-        #creates temp files with correct line endings
-        gffFileName = fixLineEndings(gffFileName)
-        fastaFileName = fixLineEndings(fastaFileName)
-        queryFastaFile = fixLineEndings(queryFastaFile)
+    #in batch mode the query-FASTA argument is a list of queries and the run-ID names the batch
+    if args.batch:
+        queries = readQueryList(queryFastaFile, sampleID)
+        if queries is None:
+            return None
+    else:
+        queries = [(queryFastaFile, sampleID)]
+
+    if not validArgs(gffFileName, fastaFileName, [query[0] for query in queries], rattType):
+        return None
+
+    global ratt_dir 
+    global scratch_dir
+    
+    ratt_dir = sampleID+"_RATT" #this is the directory that the ratt results will be stored
+    makeDirectory(ratt_dir)
+    scratch_dir = scratchDirectory(args.scratchDir, ratt_dir) #intermediate files, removed at the end unless --keep-temp
+    makeDirectory(scratch_dir)
+    manifest = loadManifest(ratt_dir, args.forceStages) #records the completed stages so a rerun can resume
+
+    #ensures end of line is LF not CRLF and the inputs are uncompressed
+    #creates temp files only for the inputs that need to be rewritten
+    tempFiles = []
+    start = usageSnapshot()
+    gffFileName = fixLineEndings(gffFileName, tempFiles)
+    fastaFileName = fixLineEndings(fastaFileName, tempFiles)
+    queries = [(fixLineEndings(queryFasta, tempFiles), runID) for queryFasta, runID in queries]
+    recordUsage(telemetry, "stage", "inputs", usageSince(start))
+    cache = None
+    if not args.noCache:
+        cache = openEmblCache(args.cacheDir, args.cacheSize, args.emblmygff3) #contig embls shared by all runs
+
+    #the stages overlap where their inputs allow: QUAST and the reference stats only need the reference fasta
+    #and each contig is converted to embl as soon as the split has written it
+    quast = None
+    if args.quast:
+        quast = startQuast(fastaFileName, ratt_dir+"/ref_quast", "quast/reference", manifest) #overlaps with the other stages
+    scheduler = TaskScheduler({"cpu":args.jobs, "tool":args.toolJobs or args.jobs})
+    try:
+        if scheduler.pool is not None:
+            scheduler.add("stats/reference", "cpu", assemblyStats, fastaFileName)
+        conversion = newEmblConversion(scheduler, args.emblmygff3, manifest, cache)
+
         try:
-            splitGenomicFiles(gffFileName, fastaFileName, contigs)
-        except OSError:
+            refFeatures = runStage(telemetry, "split", splitGenomicFiles, gffFileName, fastaFileName, contigs, args.samtools, manifest,
+                args.packSize, args.skipEmpty, lambda contig: submitEmbl(conversion, contig))
+        except (OSError, ValueError) as e:
             sys.stderr.write("***********************************************************************************\n")
             sys.stderr.write("<RATTwithGFF.py> FATAL-ERROR\n")
-            sys.stderr.write('OSError: Could not parse reference files, check that samtools is installed properly\n')
+            if isinstance(e, ValueError):
+                sys.stderr.write('ValueError: Could not index reference fasta: '+str(e)+'\n')
+            else:
+                sys.stderr.write('OSError: Could not parse reference files, check that samtools is installed properly\n')
             sys.stderr.write("***********************************************************************************\n")
-            return 0
-        
+            return None
+    
         try:
-            gffsToEmbls(contigs)
+            failed = runStage(telemetry, "embl", gffsToEmbls, contigs, conversion, args.keepGoing, telemetry)
+            if scheduler.pool is not None:
+                refStats, usage = scheduler.result("stats/reference")
+                recordUsage(telemetry, "stage", "stats/reference", usage)
+            else:
+                refStats = runStage(telemetry, "stats/reference", assemblyStats, fastaFileName)
         except OSError as e:
             sys.stderr.write("***********************************************************************************\n")
             sys.stderr.write("<RATTwithGFF.py> FATAL-ERROR\n")
             sys.stderr.write('OSError: Could not convert gff to embl, check that EMBLmyGFF is installed properly\n')
             sys.stderr.write("***********************************************************************************\n")
             print str(e)
-            return 0
-        
-        global ratt_dir 
-        
-        ratt_dir = sampleID+"_RATT" #this is the directory that the ratt results will be stored
-        
-        ratt_worked = runRatt(fastaFileName,queryFastaFile, sampleID, rattType)
-        if (ratt_worked):
-            processResults_worked = processRattResults(gffFileName)
-            if (processResults_worked):
-                printTransferStats()
-                subprocess.call(["rm",gffFileName, fastaFileName, queryFastaFile]) #removes temporary files with fixed line endings
-                elapsedTime = (timeit.default_timer() - startTime)/60
-                print("\n<RATTwithGFF.py> COMPLETE in "+format(elapsedTime,'.2f')+" minutes")
+            return None
+    finally:
+        scheduler.close() #also when a stage raises an error that is not handled here, so no workers are left behind
+
+    embls = [scratch_dir+"/contig_embl/"+contig+".embl" for contig in contigs if contig not in failed] #the contigs RATT transfers
+    result = {"rattDir":ratt_dir, "genomicGff":ratt_dir+"/final_gff/genomic.final.gff", "features":records, "stats":None}
+    if args.batch:
+        result["runIDs"] = runStage(telemetry, "batch", runBatch, queries, embls, gffFileName, rattType, args, refStats)
+        if result["runIDs"]:
+            writeBatchStats(result["runIDs"]) #combined stats of all queries in the batch directory
+        result["complete"] = len(result["runIDs"]) == len(queries)
     else:
-        return 0
+        result["stats"] = transferToQuery(embls, queries[0][0], sampleID, rattType, gffFileName, args, refStats,
+            manifest, telemetry, refFeatures, records)
+        result["runIDs"] = [sampleID] if result["stats"] is not None else []
+        result["complete"] = result["stats"] is not None
+    finishQuast(quast, fastaFileName, ratt_dir+"/ref_quast", "quast/reference", manifest, telemetry)
+    writeTelemetry(telemetry)
+    if result["complete"]:
+        printCacheStats(cache)
+        if args.keepTemp:
+            print "\n<RATTwithGFF.py> intermediate files kept in "+scratch_dir
+        else:
+            shutil.rmtree(scratch_dir) #contig files, temp files with fixed line endings and RATT's working files
+    return result
 
-#checks the input arguments to make sure they are vaid
+#parses the command line arguments
 #called by main
-def validArgs(gff, fasta1, fasta2, transType):
-    print "\n<RATTwithGFF.py> checking for valid input files..."
-    with open(gff, "r") as gffFile:
-        line = gffFile.readline()
-        if (line.find("#gff-version 3") == -1):
-            sys.stderr.write('ERROR: first argument is not a gff file\n')
-            return False
+def parseArgs(argv):
+    parser = argparse.ArgumentParser(prog="RATTwithGFF.py",
+        description="Runs the rapid annotation transfer tool (RATT) using a gff as the annotation file")
+    parser.add_argument("gff", metavar="reference-GFF", help="genomic gff containing the annotations to transfer")
+    parser.add_argument("fasta", metavar="reference-FASTA", help="genomic fasta corresponding to the reference gff")
+    parser.add_argument("queryFasta", metavar="query-FASTA", help="genomic fasta to transfer the annotations to")
+    parser.add_argument("sampleID", metavar="run-ID", help="prefix added to each RATT result file")
+    parser.add_argument("rattType", metavar="RATT-Transfer-Type", help="set of parameters RATT uses for the transfer")
+    parser.add_argument("--samtools", action="store_true",
+        help="split the reference fasta with 'samtools faidx' instead of the built-in splitter")
+    parser.add_argument("--emblmygff3", action="store_true",
+        help="convert the contig gffs to embl with EMBLmyGFF3 instead of the built-in embl writer")
+    parser.add_argument("--seqret", action="store_true",
+        help="convert the RATT results to gff with EMBOSS seqret instead of the built-in embl reader")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+        help="number of contigs converted between gff and embl at the same time (default: 1)")
+    parser.add_argument("--tool-jobs", dest="toolJobs", type=int,
+        help="number of contigs converted by EMBLmyGFF3 at the same time (default: the value of --jobs)")
+    parser.add_argument("--ratt-shards", dest="rattShards", type=int, default=1, metavar="N",
+        help="split the contig embls into N shards of about the same length and run RATT on them at the same time (default: 1)")
+    parser.add_argument("--keep-going", dest="keepGoing", action="store_true",
+        help="skip contigs that fail to convert to embl instead of stopping the run")
+    parser.add_argument("--pack-contigs", dest="packSize", type=int, default=0, metavar="BP",
+        help="pack reference contigs shorter than BP bases into multi-entry embl files of up to BP bases (default: 0, no packing)")
+    parser.add_argument("--skip-empty", dest="skipEmpty", action="store_true",
+        help="do not convert or give RATT the reference contigs that have no features in the gff")
+    parser.add_argument("--no-contig-gffs", dest="noContigGffs", action="store_true",
+        help="only write the genomic gff of the RATT results, not a gff for each query contig")
+    parser.add_argument("--bgzip", action="store_true",
+        help="also write a sorted, bgzip compressed genomic gff with a tabix index")
+    parser.add_argument("--memory-limit", dest="memoryLimit", type=int, default=0, metavar="MB",
+        help="warn when a RATT result needs more than MB megabytes of memory while one of its gene groups is fixed (default: 0, no limit)")
+    parser.add_argument("--scratch-dir", dest="scratchDir",
+        help="directory for the intermediate files of the run, such as node-local storage (default: <run-ID>_RATT/scratch)")
+    parser.add_argument("--keep-temp", dest="keepTemp", action="store_true",
+        help="keep the intermediate files in the scratch directory after a successful run")
+    parser.add_argument("--force-stage", dest="forceStages", action="append", default=[], choices=STAGES,
+        help="rerun a stage even if the run manifest shows it is up to date, can be given more than once")
+    parser.add_argument("--batch", action="store_true",
+        help="query-FASTA is a list of queries, one 'query-FASTA [run-ID]' per line, that are all transferred from the reference")
+    parser.add_argument("--max-queries", dest="maxQueries", type=int, default=1,
+        help="number of queries transferred at the same time in batch mode (default: 1)")
+    parser.add_argument("--quast", action="store_true",
+        help="also run QUAST on the reference and the query, in the background while RATT runs")
+    parser.add_argument("--profile", action="store_true",
+        help="run the Python stages under cProfile and write the profiles to <run-ID>_RATT/profile")
+    parser.add_argument("--cache-dir", dest="cacheDir", default=DEFAULT_CACHE_DIR,
+        help="directory of the contig embl cache shared between runs (default: "+DEFAULT_CACHE_DIR+")")
+    parser.add_argument("--cache-size", dest="cacheSize", type=int, default=DEFAULT_CACHE_SIZE,
+        help="size limit of the embl cache in MB, least recently used embls are removed first (default: "+str(DEFAULT_CACHE_SIZE)+")")
+    parser.add_argument("--no-cache", dest="noCache", action="store_true",
+        help="always convert the contig gffs to embl instead of using the embl cache")
+    args = parser.parse_args(argv)
+    error = checkOptions(args)
+    if error is not None:
+        parser.error(error)
+    return args
+
+#checks the values of the numeric options
+#returns the error message for the first invalid one, or None if they are all valid
+#called by parseArgs and transfer
+def checkOptions(args):
+    if args.jobs < 1:
+        return "--jobs must be at least 1"
+    if args.toolJobs is not None and args.toolJobs < 1:
+        return "--tool-jobs must be at least 1"
+    if args.rattShards < 1:
+        return "--ratt-shards must be at least 1"
+    if args.maxQueries < 1:
+        return "--max-queries must be at least 1"
+    if args.packSize < 0:
+        return "--pack-contigs can not be negative"
+    if args.cacheSize < 0:
+        return "--cache-size can not be negative"
+    if args.memoryLimit < 0:
+        return "--memory-limit can not be negative"
+    return None
+
+#these are the options for RATT transfer type
+RATT_TRANSFER_TYPES = ["Assembly", "Assembly.Repetitive", "Strain", "Strain.Repetitive", "Species", "Species.Repetitive", "Multiple"]
 
-    with open(fasta1, "r") as fastaFile:
-        line = fastaFile.readline()
-        if (line.find('>') == -1):
-            sys.stderr.write('ERROR: second argument is not a fasta file\n')
-            return False
-    
-    with open(fasta2, "r") as fastaFile:
-        line = fastaFile.readline()
-        if (line.find('>') == -1):
-            sys.stderr.write('ERROR: second argument is not a fasta file\n')
-            return False
-    
-    #these are the options for RATT transfer type
-    validTypes = ["Assembly", "Assembly.Repetitive", "Strain", "Strain.Repetitive", "Species", "Species.Repetitive", "Multiple"]
-    if transType in validTypes:
-        print "\n<RATTwithGFF.py> input files are valid"
-        return True
-    else:
-        sys.stderr.write("ERROR: '"+transType+"' is not a valid RATT transfer type\n")
-        sys.stderr.write('VALID TRANSFER TYPES: Assembly, Assembly.Repetitive, Strain, Strain.Repetitive, Species, Species.Repetitive, Multiple\n')
+#checks the input arguments to make sure they are vaid
+#called by runTransfer
+def validArgs(gff, fasta1, queryFastas, transType):
+    print "\n<RATTwithGFF.py> checking for valid input files..."
+    error = inputError(gff, fasta1, queryFastas, transType)
+    if error is not None:
+        sys.stderr.write("ERROR: "+error+"\n")
+        if transType not in RATT_TRANSFER_TYPES:
+            sys.stderr.write("VALID TRANSFER TYPES: "+", ".join(RATT_TRANSFER_TYPES)+"\n")
         return False
+    print "\n<RATTwithGFF.py> input files are valid"
+    return True
 
-#checks line ending format
-#creates a temp file with LF line endings
-def fixLineEndings(fileName):
-    newFileName = "temp_"+fileName
+#returns why the input files or the transfer type are not valid, or None if they are
+#called by validArgs and transfer
+def inputError(gff, fasta1, queryFastas, transType):
+    with openInput(gff) as gffFile:
+        if (gffFile.readline().find("#gff-version 3") == -1):
+            return "first argument is not a gff file"
+
+    with openInput(fasta1) as fastaFile:
+        if (fastaFile.readline().find('>') == -1):
+            return "second argument is not a fasta file"
+
+    for fasta2 in queryFastas:
+        with openInput(fasta2) as fastaFile:
+            if (fastaFile.readline().find('>') == -1):
+                return "query "+fasta2+" is not a fasta file"
+
+    if transType not in RATT_TRANSFER_TYPES:
+        return "'"+transType+"' is not a valid RATT transfer type"
+    return None
+
+#extensions removed from a query fasta name to make its default run-ID
+QUERY_EXTENSIONS = [".gz", ".fasta", ".fa", ".fna", ".fas"]
+
+#reads the list of queries used in batch mode
+#each line holds a query fasta and optionally its run-ID, blank lines and lines starting with '#' are skipped
+#without a run-ID the name of the fasta without its extensions is used
+#returns a list of (query fasta, run-ID) or None if the list is not valid
+#called by runTransfer
+def readQueryList(fileName, batchID):
+    queries = []
+    runIDs = set([batchID])
+    with open(fileName) as file:
+        for line in file:
+            values = line.split()
+            if not values or values[0].startswith("#"):
+                continue
+            queryFasta = values[0]
+            if len(values) > 1:
+                runID = values[1]
+            else:
+                runID = os.path.basename(queryFasta)
+                for extension in QUERY_EXTENSIONS:
+                    if runID.endswith(extension):
+                        runID = runID[:-len(extension)]
+            if not os.path.isfile(queryFasta):
+                sys.stderr.write("ERROR: query "+queryFasta+" listed in "+fileName+" does not exist\n")
+                return None
+            if runID in runIDs:
+                sys.stderr.write("ERROR: run-ID '"+runID+"' in "+fileName+" is already used by another query or by the batch\n")
+                return None
+            runIDs.add(runID)
+            queries.append((queryFasta, runID))
+    if not queries:
+        sys.stderr.write("ERROR: "+fileName+" does not list any queries\n")
+        return None
+    return queries
+
+#size of the blocks used to scan and rewrite the input files
+IO_BLOCK_SIZE = 4*1024*1024
+
+#checks if a file starts with the gzip magic number, bgzip files are gzip files as well
+#called by openInput and fixLineEndings
+def isGzipped(fileName):
+    with open(fileName, "rb") as file:
+        return file.read(2) == "\x1f\x8b"
+
+#opens an input file for reading, decompressing it on the fly when it is gzipped
+#called by validArgs
+def openInput(fileName):
+    if isGzipped(fileName):
+        return gzip.open(fileName, "rb")
+    return open(fileName, "r")
+
+#checks if an uncompressed file contains any CR, reading it in large blocks and stopping at the first one
+#called by fixLineEndings
+def hasCarriageReturns(fileName):
+    with open(fileName, "rb") as file:
+        while True:
+            block = file.read(IO_BLOCK_SIZE)
+            if not block:
+                return False
+            if block.find("\r") != -1:
+                return True
+
+#checks line ending format and compression
+#inputs that are uncompressed and already use LF line endings are used in place
+#otherwise creates a temp file with LF line endings, decompressing gzip/bgzip inputs
+#the temp file is written to scratch_dir and added to tempFiles, its name holds a hash of the absolute path of the input
+#so that inputs with the same name in different directories (or x.fa and x.fa.gz) get their own temp files
+#called by runTransfer
+def fixLineEndings(fileName, tempFiles):
+    gzipped = isGzipped(fileName)
+    if not gzipped and not hasCarriageReturns(fileName):
+        return fileName
+
+    key = hashlib.md5(os.path.abspath(fileName)).hexdigest()[:8]
+    newFileName = scratch_dir+"/temp_"+key+"_"+os.path.basename(fileName)
+    if gzipped and newFileName.endswith(".gz"):
+        newFileName = newFileName[:-3]
+    if newFileName in tempFiles:
+        return newFileName #the same input was given twice
+    print "\n<RATTwithGFF.py> writing "+newFileName+" with LF line endings..."
     with open(newFileName,"wb") as outFile:
-        with open(fileName) as file:
-            for line in file:
-                if line.find("\r") != -1:
-                    newLine = line.replace("\r","")
-                else:
-                    newLine = line    
-                outFile.write(newLine)
+        with open(fileName,"rb") as file:
+            if gzipped:
+                copyGzipWithoutCR(file, outFile)
+            else:
+                block = file.read(IO_BLOCK_SIZE)
+                while block:
+                    outFile.write(block.replace("\r",""))
+                    block = file.read(IO_BLOCK_SIZE)
+    tempFiles.append(newFileName)
     return newFileName
 
+#decompresses a gzip file block by block and removes all CR
+#handles files made of several gzip members, like bgzip files
+#called by fixLineEndings
+def copyGzipWithoutCR(file, outFile):
+    decompressor = zlib.decompressobj(16+zlib.MAX_WBITS)
+    block = file.read(IO_BLOCK_SIZE)
+    while block:
+        outFile.write(decompressor.decompress(block).replace("\r",""))
+        if decompressor.unused_data:
+            block = decompressor.unused_data
+            decompressor = zlib.decompressobj(16+zlib.MAX_WBITS) #start of the next member
+        else:
+            block = file.read(IO_BLOCK_SIZE)
+    outFile.write(decompressor.flush().replace("\r",""))
+
+
+
+#name of the run manifest, stored in the RATT directory
+#records the steps that finished with content hashes of their inputs and outputs so a rerun can skip them
+MANIFEST_NAME = "manifest.json"
+
+#stages recorded in the run manifest, in the order they run
+#contig steps are recorded as <stage>/<name>, e.g. embl/chr1
+STAGES = ["split", "embl", "quast", "ratt", "results"]
+
+#minimum number of seconds between manifest saves while contigs are being converted
+MANIFEST_SAVE_INTERVAL = 30
+
+#loads the run manifest from the RATT directory and drops the steps of the stages that are forced to rerun
+#starts an empty manifest if there is none or it can not be read
+#called by runTransfer and batchQuery
+def loadManifest(rattDir, forceStages=None):
+    if forceStages is None:
+        forceStages = []
+    manifest = {"path":rattDir+"/"+MANIFEST_NAME, "steps":{}, "files":{}, "saved":timeit.default_timer()}
+    if os.path.exists(manifest["path"]):
+        try:
+            with open(manifest["path"]) as file:
+                saved = json.load(file)
+            manifest["steps"] = saved["steps"]
+            manifest["files"] = saved["files"]
+            print "\n<RATTwithGFF.py> resuming from "+manifest["path"]+" ("+str(len(manifest["steps"]))+" completed steps)"
+        except (ValueError, KeyError, TypeError):
+            sys.stderr.write("<RATTwithGFF.py> WARNING: could not read "+manifest["path"]+", every stage will be rerun\n")
+    for stage in forceStages:
+        invalidateStage(manifest, stage)
+    return manifest
+
+#writes the manifest to a temp file and renames it so a killed run never leaves a truncated manifest
+#unless force is set, the manifest is only written when MANIFEST_SAVE_INTERVAL seconds passed since the last save
+#called by runTransfer, recordStep and the stage functions
+def saveManifest(manifest, force=True):
+    if manifest is None:
+        return
+    now = timeit.default_timer()
+    if not force and now - manifest["saved"] < MANIFEST_SAVE_INTERVAL:
+        return
+    with open(manifest["path"]+".tmp", "w") as file:
+        json.dump({"steps":manifest["steps"], "files":manifest["files"]}, file, indent=1, sort_keys=True)
+    os.rename(manifest["path"]+".tmp", manifest["path"])
+    manifest["saved"] = now
+
+#removes a stage and all of its contig steps from the manifest
+#called by loadManifest and runRatt
+def invalidateStage(manifest, stage):
+    for step in manifest["steps"].keys():
+        if step == stage or step.startswith(stage+"/"):
+            del manifest["steps"][step]
+
+#returns the md5 of a file
+#the hash is cached in the manifest with the size and modification time of the file
+#so unchanged files are not read again
+#called by recordStep and getValidStep
+def hashFile(manifest, fileName):
+    stat = os.stat(fileName)
+    cached = manifest["files"].get(fileName)
+    if cached is not None and cached[0] == stat.st_size and cached[1] == stat.st_mtime:
+        return cached[2]
+    md5 = hashlib.md5()
+    with open(fileName, "rb") as file:
+        block = file.read(IO_BLOCK_SIZE)
+        while block:
+            md5.update(block)
+            block = file.read(IO_BLOCK_SIZE)
+    manifest["files"][fileName] = [stat.st_size, stat.st_mtime, md5.hexdigest()]
+    return md5.hexdigest()
+
+#returns the manifest record of a step if it ran with the same options and inputs and its outputs are unchanged
+#returns None if the step has to be (re)run
+#called by the stage functions
+def getValidStep(manifest, step, inputs, options):
+    if manifest is None:
+        return None
+    record = manifest["steps"].get(step)
+    if record is None or record["options"] != options or sorted(record["inputs"]) != sorted(inputs):
+        return None
+    for files in (record["inputs"], record["outputs"]):
+        for fileName in files:
+            if not os.path.isfile(fileName) or hashFile(manifest, fileName) != files[fileName]:
+                return None
+    return record
+
+#records a finished step with the hashes of its inputs and outputs
+#extra values are stored with the step, e.g. the contig names found by the split
+#called by the stage functions
+def recordStep(manifest, step, inputs, outputs, options, **extra):
+    if manifest is None:
+        return
+    record = {"inputs":{}, "outputs":{}, "options":options}
+    for fileName in inputs:
+        record["inputs"][fileName] = hashFile(manifest, fileName)
+    for fileName in outputs:
+        record["outputs"][fileName] = hashFile(manifest, fileName)
+    record.update(extra)
+    manifest["steps"][step] = record
+    saveManifest(manifest, False)
+
+#stages whose work is done in Python, they are run under cProfile with --profile
+PROFILED_STAGES = set(["split", "embl", "results", "stats/reference", "stats/query", "stats/transfer"])
+
+#columns of the telemetry tsv, times are in seconds and the peak RSS in KB
+TELEMETRY_COLUMNS = ["kind", "name", "wall", "cpu", "childCpu", "peakRssKb", "bytesRead", "bytesWritten"]
+
+#creates the telemetry of a run, a list of usage records for the stages, external commands and contigs
+#called by runTransfer and batchQuery
+def newTelemetry(profile=False):
+    return {"records":[], "profile":profile, "start":usageSnapshot()}
+
+#returns the bytes read and written by this process, from /proc/self/io
+#like RUSAGE_CHILDREN the counters include the children that were waited for, e.g. the workers of a finished pool
+#returns zeros where /proc is not available
+#called by usageSnapshot
+def readIOCounters():
+    counters = {}
+    try:
+        with open("/proc/self/io") as io:
+            for line in io:
+                name, value = line.split(":")
+                counters[name] = int(value)
+    except (IOError, ValueError):
+        pass
+    return counters.get("rchar", 0), counters.get("wchar", 0)
+
+#returns the wall time, CPU time of this process and its waited-for children, peak RSS and I/O counters
+#called by newTelemetry, timedTask and runStage
+def usageSnapshot():
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    bytesRead, bytesWritten = readIOCounters()
+    return (timeit.default_timer(), own.ru_utime+own.ru_stime, children.ru_utime+children.ru_stime,
+        max(own.ru_maxrss, children.ru_maxrss), bytesRead, bytesWritten)
+
+#returns the usage since a snapshot as a telemetry record
+#the peak RSS is a high-water mark of this process and its children, so it can include earlier stages
+#called by timedTask and runStage
+def usageSince(start):
+    end = usageSnapshot()
+    return {"wall":end[0]-start[0], "cpu":(end[1]-start[1])+(end[2]-start[2]), "childCpu":end[2]-start[2],
+        "peakRssKb":end[3], "bytesRead":end[4]-start[4], "bytesWritten":end[5]-start[5]}
+
+#runs function(args) and returns its result with the usage of the call
+#used as the pool function so that each contig is measured in the process that converts it
+#called by scheduledTask and processRattResults
+def timedTask(task):
+    function, args = task
+    start = usageSnapshot()
+    result = function(args)
+    return result, usageSince(start)
+
+#runs a task in a worker of a TaskScheduler, an exception is returned so it can be raised by TaskScheduler.result
+#called by TaskScheduler
+def scheduledTask(task):
+    try:
+        return True, timedTask(task)
+    except Exception as e:
+        return False, e
+
+#runs tasks as soon as the tasks they need have finished, in a pool of worker processes
+#each task has a resource class and at most limits[resource] tasks of a class run at the same time
+#"cpu" tasks run Python passes, "tool" tasks mostly wait for an external program such as EMBLmyGFF3
+#the pool has as many workers as the largest limit, the classes share them so no more tasks run than that limit
+#when no class may run more than one task the tasks run in the calling process as they are added,
+#so that they are included in the profiles of --profile
+#the pool is started before any task is added, so the workers are forked from a small process
+#called by runTransfer
+class TaskScheduler(object):
+    def __init__(self, limits):
+        self.limits = limits
+        self.pool = None
+        self.workers = set()
+        if max(limits.values()) > 1:
+            self.pool = multiprocessing.Pool(max(limits.values()))
+            self.workers = set(worker.pid for worker in self.pool._pool) #a worker that dies is replaced by a new pid
+        self.condition = threading.Condition() #guards the state below, pool callbacks run in another thread
+        self.waiting = [] #[name, resource, function, args, needs] in the order they were added
+        self.started = {} #name -> (resource, AsyncResult) of the tasks running in the pool
+        self.running = collections.Counter()
+        self.done = set()
+        self.results = {} #name -> (worked, (result, usage)) until it is collected
+        self.closed = False #no task is started once the pool is being stopped
+
+    #adds a task that runs function(args) once the tasks named in needs have finished
+    def add(self, name, resource, function, args, needs=()):
+        if self.pool is None:
+            self.results[name] = scheduledTask((function, args))
+            self.done.add(name)
+            return
+        with self.condition:
+            self.waiting.append([name, resource, function, args, needs])
+            self.dispatch()
+
+    #starts the waiting tasks that can run, called with the condition held
+    def dispatch(self):
+        if self.closed:
+            return
+        for task in list(self.waiting):
+            name, resource, function, args, needs = task
+            if self.running[resource] >= self.limits[resource] or not self.done.issuperset(needs):
+                continue
+            self.waiting.remove(task)
+            self.running[resource] += 1
+            self.started[name] = (resource, self.pool.apply_async(scheduledTask, [(function, args)],
+                callback=self.finisher(name, resource)))
+
+    #returns the pool callback of a task
+    def finisher(self, name, resource):
+        def finish(result):
+            with self.condition:
+                self.finish(name, resource, result)
+        return finish
+
+    #stores the result of a task and starts the tasks that waited for it, called with the condition held
+    def finish(self, name, resource, result):
+        self.started.pop(name, None)
+        self.results[name] = result
+        self.done.add(name)
+        self.running[resource] -= 1
+        self.dispatch()
+        self.condition.notify_all()
+
+    #fails the tasks whose result could not be sent back by the pool, which does not call their callback,
+    #and raises OSError when a worker died (e.g. killed when out of memory), as the task it ran is lost
+    #called with the condition held
+    def checkWorkers(self):
+        for name, started in self.started.items():
+            if started[1].ready(): #the callback of a task that worked has already run
+                try:
+                    started[1].get()
+                except Exception as e:
+                    self.finish(name, started[0], (False, e))
+        if self.started and any(worker.pid not in self.workers for worker in self.pool._pool):
+            raise OSError("a worker process died while running "+", ".join(sorted(self.started)))
+
+    #waits for a task and returns its (result, usage), the exception of a failed task is raised
+    def result(self, name):
+        with self.condition:
+            while name not in self.results:
+                self.condition.wait(1) #a timeout keeps the wait interruptible
+                self.checkWorkers()
+            worked, result = self.results.pop(name)
+        if not worked:
+            raise result
+        return result
+
+    #stops the workers, tasks that are still running are abandoned
+    #the condition is only held to mark the scheduler closed, the callbacks of finishing tasks need it to return
+    def close(self):
+        with self.condition:
+            self.closed = True
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+#adds a usage record to the telemetry
+#called by runStage, waitForCommand, gffsToEmbls, processRattResults and runTransfer
+def recordUsage(telemetry, kind, name, usage):
+    if telemetry is None:
+        return
+    record = {"kind":kind, "name":name}
+    record.update(usage)
+    telemetry["records"].append(record)
+
+#runs a stage of the pipeline, records its usage and writes the telemetry report
+#with --profile the Python stages run under cProfile, the profile is written to ratt_dir/profile/<stage>.prof and .txt
+#returns the result of the stage function
+#called by runTransfer and transferToQuery
+def runStage(telemetry, name, function, *args):
+    if telemetry is None:
+        return function(*args)
+    profiler = None
+    if telemetry["profile"] and name in PROFILED_STAGES:
+        profiler = cProfile.Profile()
+    start = usageSnapshot()
+    try:
+        if profiler is not None:
+            return profiler.runcall(function, *args)
+        return function(*args)
+    finally:
+        recordUsage(telemetry, "stage", name, usageSince(start))
+        if profiler is not None:
+            writeProfile(profiler, name)
+        writeTelemetry(telemetry)
+
+#writes a profile as a pstats file and as text sorted by cumulative time
+#called by runStage
+def writeProfile(profiler, name):
+    makeDirectory(ratt_dir+"/profile")
+    fileName = ratt_dir+"/profile/"+name.replace("/", ".")
+    profiler.dump_stats(fileName+".prof")
+    with open(fileName+".txt", "w") as text:
+        pstats.Stats(profiler, stream=text).sort_stats("cumulative").print_stats(40)
+
+#waits for an external command started with Popen and records its usage
+#os.wait4 gives the CPU time and peak RSS of the command itself (and the processes it waited for)
+#returns the exit status of the command
+#called by runRatt and finishQuast
+def waitForCommand(process, started, telemetry, name):
+    pid, status, usage = os.wait4(process.pid, 0)
+    if os.WIFSIGNALED(status):
+        process.returncode = -os.WTERMSIG(status)
+    else:
+        process.returncode = os.WEXITSTATUS(status)
+    recordUsage(telemetry, "command", name, {"wall":timeit.default_timer()-started, "cpu":usage.ru_utime+usage.ru_stime,
+        "childCpu":usage.ru_utime+usage.ru_stime, "peakRssKb":usage.ru_maxrss, "bytesRead":None, "bytesWritten":None})
+    return process.returncode
+
+#writes the telemetry of the run to ratt_dir/telemetry.json and ratt_dir/telemetry.tsv
+#called by runStage and runTransfer
+def writeTelemetry(telemetry):
+    if telemetry is None:
+        return
+    total = {"kind":"run", "name":"total"}
+    total.update(usageSince(telemetry["start"]))
+    with open(ratt_dir+"/telemetry.json", "w") as report:
+        json.dump({"records":telemetry["records"], "total":total}, report, indent=1, sort_keys=True)
+    with open(ratt_dir+"/telemetry.tsv", "w") as report:
+        report.write("\t".join(TELEMETRY_COLUMNS)+"\n")
+        for record in telemetry["records"]+[total]:
+            values = []
+            for column in TELEMETRY_COLUMNS:
+                value = record[column]
+                if value is None:
+                    value = ""
+                elif isinstance(value, float):
+                    value = format(value, '.3f')
+                values.append(str(value))
+            report.write("\t".join(values)+"\n")
+
+#creates a directory if it does not exist yet
+#called by runTransfer, splitGenomicFiles and runRatt
+def makeDirectory(directory):
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+#returns the scratch directory of the run, where the contig files, temp files and RATT's working files are written
+#without a base directory it is inside the RATT directory, otherwise it is a directory in baseDir named after
+#the RATT directory and its absolute path, so runs in different directories can share baseDir and a rerun finds it again
+#called by runTransfer
+def scratchDirectory(baseDir, rattDir):
+    if baseDir is None:
+        return rattDir+"/scratch"
+    key = hashlib.md5(os.path.abspath(rattDir)).hexdigest()[:8]
+    return os.path.join(baseDir, os.path.basename(rattDir)+"."+key)
 
 
 #converts a genomic gff into seperate gffs for each contig
 #converts a genoic fasta into a fasta for each contig
-#called by main
-def splitGenomicFiles(gff, fasta, contigNames):
+#contigs shorter than packSize are packed together into a single gff and fasta, see planContigUnits
+#contigNames is filled with the names of the contig files (a contig or a pack)
+#ready is called with each contig file that is complete, see splitGff
+#skipped when the manifest shows the contig files were already made from the same inputs
+#returns the reference features counted in the transfer stats (see splitGff), or None when the split was skipped
+#called by runTransfer
+def splitGenomicFiles(gff, fasta, contigNames, useSamtools=False, manifest=None, packSize=0, skipEmpty=False, ready=None):
+    options = {"samtools":useSamtools, "packSize":packSize, "skipEmpty":skipEmpty}
+    step = getValidStep(manifest, "split", [gff, fasta], options)
+    if step is not None and os.path.exists(scratch_dir+"/"+REFERENCE_FEATURES): #runs made before the feature table was added redo the split
+        print "\n<RATTwithGFF.py> contig fastas and gffs are up to date, skipping split..."
+        contigNames.extend(step["contigs"])
+        return
+
     print "\n<RATTwithGFF.py> Indexing fasta.."
-    subprocess.call(["samtools","faidx",fasta])
-    index = fasta+".fai"
-    
-    with open(index,"r") as fai:
-        for line in fai:
-            contigNames.append(line.split("\t")[0]) #makes a list of all contigs from fasta index
+    if useSamtools:
+        subprocess.call(["samtools","faidx",fasta])
+        index = readFastaIndex(fasta+".fai")
+    else:
+        index = getFastaIndex(fasta)
+
+    annotated = None
+    if skipEmpty:
+        annotated = getAnnotatedContigs(gff)
+        skipped = len([entry for entry in index if entry[0] not in annotated])
+        print "\n<RATTwithGFF.py> skipping "+str(skipped)+" contig(s) without features..."
+        index = [entry for entry in index if entry[0] in annotated]
+    units = planContigUnits(index, packSize)
+    contigNames.extend(units.keys()) #makes a list of all contig files from fasta index
+    packs = [contigs for contigs in units.values() if len(contigs) > 1]
+    if packs:
+        print "\n<RATTwithGFF.py> packing "+str(sum(len(contigs) for contigs in packs))+" small contigs into "+str(len(packs))+" multi-entry file(s)..."
+    unitOf = {}
+    for unit, contigs in units.iteritems():
+        for contig in contigs:
+            unitOf[contig] = unit
     
-    subprocess.call(["mkdir","contig_gff"])
-    subprocess.call(["mkdir","contig_fasta"])
-    subprocess.call(["mkdir","contig_embl"])
+    makeDirectory(scratch_dir+"/contig_gff")
+    makeDirectory(scratch_dir+"/contig_fasta")
+    makeDirectory(scratch_dir+"/contig_embl")
+    makeDirectory(scratch_dir+"/contig_embl_logs")
+
+    #embl files left from a previous reference would otherwise be given to RATT
+    #removed before the split hands any contig to ready, whose conversion may already be writing its embl
+    contigSet = set(contigNames)
+    for embl in os.listdir(scratch_dir+"/contig_embl"):
+        if embl.endswith(".embl") and embl[:-len(".embl")] not in contigSet:
+            os.remove(scratch_dir+"/contig_embl/"+embl)
 
     print "\n<RATTwithGFF.py> Generating contig fastas and gffs..."
+    if useSamtools:
+        for unit, contigs in units.iteritems():
+            output = subprocess.check_output(["samtools","faidx", fasta]+contigs) #gets sequence specific for a contig
+            
+            with open(scratch_dir+"/contig_fasta/"+unit+".fa", "w") as contigFasta:
+                contigFasta.write(output)
+    else:
+        splitFasta(fasta, index, unitOf)
+
+    features = splitGff(gff, contigNames, unitOf, ready)
+    writeReferenceFeatures(features)
+
+    outputs = [scratch_dir+"/"+REFERENCE_FEATURES]
     for contig in contigNames:
-        output = subprocess.check_output(["samtools","faidx", fasta, contig]) #gets sequence specific for a contig
-        
-        with open("contig_fasta/"+contig+".fa", "w") as contigFasta:
-            contigFasta.write(output)
-    
+        outputs.append(scratch_dir+"/contig_gff/"+contig+".gff")
+        outputs.append(scratch_dir+"/contig_fasta/"+contig+".fa")
+    recordStep(manifest, "split", [gff, fasta], outputs, options, contigs=contigNames)
+    saveManifest(manifest)
+    return features
+
+#prefix of the files that hold several small contigs, see planContigUnits
+PACK_PREFIX = "packed_"
+
+#returns the set of contigs that have at least one feature in the genomic gff
+#called by splitGenomicFiles
+def getAnnotatedContigs(gff):
+    annotated = set()
+    with open(gff,"r") as gffFile:
+        for line in gffFile:
+            if line.startswith("##FASTA"):
+                break
+            if line.startswith("#") or "\t" not in line:
+                continue
+            annotated.add(line[:line.find("\t")])
+    return annotated
+
+#decides which file each contig is split into, in the order of the fasta index
+#contigs shorter than packSize are packed, in fasta order, into files of at most packSize bases
+#so fragmented assemblies do not need a gff, fasta, embl and conversion for every tiny contig
+#returns an ordered dict of file name to the list of contigs in it
+#called by splitGenomicFiles
+def planContigUnits(index, packSize=0):
+    units = collections.OrderedDict()
+    names = set(entry[0] for entry in index)
+    pack = []
+    packLength = 0
+    packNumber = 0
+    for entry in index:
+        if entry[1] >= packSize:
+            units[entry[0]] = [entry[0]]
+            continue
+        if pack and packLength+entry[1] > packSize:
+            pack = []
+        if not pack:
+            packNumber += 1
+            packName = PACK_PREFIX+str(packNumber)
+            while packName in names or packName in units:
+                packName += "_"
+            units[packName] = pack
+            packLength = 0
+        pack.append(entry[0])
+        packLength += entry[1]
+    #a pack of one contig is just that contig
+    return collections.OrderedDict((contigs[0] if len(contigs) == 1 else unit, contigs) for unit, contigs in units.iteritems())
+
+#line width used by 'samtools faidx' when writing sequences
+FASTA_LINE_WIDTH = 60
+
+# [0]:name [1]:length [2]:offset [3]:bases per line [4]:bytes per line
+#reads a samtools style fasta index into a list of entries
+#called by splitGenomicFiles
+def readFastaIndex(index):
+    entries = []
+    with open(index,"r") as fai:
+        for line in fai:
+            values = line.rstrip("\n").split("\t")
+            entries.append([values[0]]+[int(x) for x in values[1:5]])
+    return entries
+
+#uses the existing .fai for the fasta if it is up to date, otherwise builds and writes a new one
+#the .fai is written next to the fasta, or to scratch_dir when the directory of the fasta is not writable
+#called by splitGenomicFiles
+def getFastaIndex(fasta):
+    indexes = [fasta+".fai", scratch_dir+"/"+os.path.basename(fasta)+".fai"]
+    for index in indexes:
+        if os.path.exists(index) and os.path.getmtime(index) >= os.path.getmtime(fasta):
+            return readFastaIndex(index)
+    entries = buildFastaIndex(fasta)
+    for index in indexes:
+        if writeFastaIndex(entries, index):
+            break
+    return entries #if neither could be written the index is only needed in memory
+
+#writes a fasta index to a temp file in the same directory and renames it into place
+#runs on the same reference may build their index at the same time, none of them reads a half-written .fai
+#returns False if the index could not be written
+#called by getFastaIndex
+def writeFastaIndex(entries, index):
+    tempIndex = index+"."+str(os.getpid())+".tmp"
+    try:
+        with open(tempIndex,"w") as fai:
+            for entry in entries:
+                fai.write("\t".join([str(x) for x in entry])+"\n")
+        os.rename(tempIndex, index)
+    except (IOError, OSError):
+        if os.path.exists(tempIndex):
+            os.remove(tempIndex)
+        return False
+    return True
+
+#builds a samtools compatible index of the fasta in one pass
+#every line of a sequence except the last must have the same length
+#called by getFastaIndex
+def buildFastaIndex(fasta):
+    entries = []
+    entry = None
+    offset = 0
+    lastLine = False #true once a sequence line shorter than the others has been seen
+    with open(fasta,"rb") as fastaFile:
+        for line in fastaFile:
+            offset += len(line)
+            if line.startswith(">"):
+                name = line[1:].split()[0] if line[1:].strip() else ""
+                entry = [name, 0, offset, 0, 0]
+                entries.append(entry)
+                lastLine = False
+                continue
+            if entry is None:
+                raise ValueError("'"+fasta+"' does not start with a fasta header")
+            bases = len(line.rstrip("\r\n"))
+            if bases == 0:
+                lastLine = True
+                continue
+            hasNewline = len(line) != bases
+            if entry[3] == 0:
+                entry[3] = bases
+                entry[4] = len(line) if hasNewline else bases+1
+            elif lastLine or bases > entry[3] or (bases == entry[3] and hasNewline and len(line) != entry[4]):
+                raise ValueError("different line length in sequence '"+entry[0]+"'")
+            if bases < entry[3] or not hasNewline:
+                lastLine = True
+            entry[1] += bases
+    return entries
+
+#writes every contig in the index to its own fasta using a single memory-mapped view of the genomic fasta
+#the sequence is rewrapped to FASTA_LINE_WIDTH so that the output is identical to 'samtools faidx'
+#called by splitGenomicFiles
+def splitFasta(fasta, index, unitOf=None):
+    with open(fasta,"rb") as fastaFile:
+        if os.path.getsize(fasta) == 0:
+            return
+        sequence = mmap.mmap(fastaFile.fileno(), 0, access=mmap.ACCESS_READ)
+        started = set()
+        try:
+            for entry in sorted(index, key=lambda x: x[2]): #sequential sweep through the fasta
+                unit = entry[0] if unitOf is None else unitOf[entry[0]]
+                mode = "ab" if unit in started else "wb" #packed contigs are added to the fasta of their pack
+                started.add(unit)
+                with open(scratch_dir+"/contig_fasta/"+unit+".fa",mode) as contigFasta:
+                    contigFasta.write(">"+entry[0]+"\n")
+                    writeWrappedSequence(sequence, entry, contigFasta)
+        finally:
+            sequence.close()
+
+#copies the sequence of one index entry to the output, wrapping lines at FASTA_LINE_WIDTH
+#called by splitFasta
+def writeWrappedSequence(sequence, entry, outFile):
+    name, length, offset, lineBases, lineWidth = entry
+    if length == 0:
+        return
+    end = offset + ((length-1)//lineBases)*lineWidth + (length-1)%lineBases + 1
+    if lineBases == FASTA_LINE_WIDTH and lineWidth == FASTA_LINE_WIDTH+1:
+        outFile.write(sequence[offset:end]) #already wrapped like samtools output
+        outFile.write("\n")
+        return
+
+    #rewraps the sequence one block of lines at a time
+    blockLines = max(1, (1 << 20)//lineWidth)
+    leftover = ""
+    for blockStart in xrange(offset, end, blockLines*lineWidth):
+        block = sequence[blockStart:min(end, blockStart+blockLines*lineWidth)]
+        bases = leftover + block.replace("\n","").replace("\r","")
+        full = len(bases) - len(bases)%FASTA_LINE_WIDTH
+        for x in xrange(0, full, FASTA_LINE_WIDTH):
+            outFile.write(bases[x:x+FASTA_LINE_WIDTH])
+            outFile.write("\n")
+        leftover = bases[full:]
+    if leftover:
+        outFile.write(leftover)
+        outFile.write("\n")
+
+#maximum number of contig gffs that are held open at once while splitting the genomic gff
+MAX_OPEN_GFFS = 256
+
+#returns an open handle for the contig gff, reopening it in append mode if it was closed
+#closes the least recently used handle when more than MAX_OPEN_GFFS are open
+#called by splitGff
+def getContigGffHandle(contig, openGffs, started):
+    if contig in openGffs:
+        handle = openGffs.pop(contig)
+    else:
+        if len(openGffs) >= MAX_OPEN_GFFS:
+            openGffs.popitem(last=False)[1].close()
+        if contig in started:
+            handle = open(scratch_dir+"/contig_gff/"+contig+".gff","a")
+        else:
+            handle = open(scratch_dir+"/contig_gff/"+contig+".gff","w")
+            handle.write("##gff-version 3\n")
+            started.add(contig)
+    openGffs[contig] = handle #re-inserting marks the handle as most recently used
+    return handle
+
+#streams the genomic gff once and writes each feature to the gff of the contig in its first column
+#unitOf maps each contig to the name of its gff, a packed contig is written to the gff of its pack
+#returns the [contig, type, ID] of each feature counted in the transfer stats, see tallyFeature
+#'##sequence-region' directives are kept with their contig, other comments and the ##FASTA section are dropped
+#ready is called with each contig gff (contig or pack) once it is complete, so it can be converted while the split goes on
+#in a gff grouped by contig a contig is complete when the next contig starts, once a contig turns up again
+#the remaining gffs are only given to ready at the end, together with the ones that grew after they were given
+#called by splitGenomicFiles
+def splitGff(gff, contigNames, unitOf=None, ready=None):
+    print "\n<RATTwithGFF.py> adding ncRNA_class=other and Parent notes to contig gffs..."
+    if unitOf is None:
+        unitOf = dict((contig, contig) for contig in contigNames)
+    openGffs = collections.OrderedDict()
+    started = set()
+    features = []
+    seen = set()
+    remaining = collections.Counter(unitOf.values()) #contigs of each gff that are not complete yet
+    reported = set()
+    passed = set()
+    current = None
+    grouped = ready is not None
+    try:
         with open(gff,"r") as gffFile:
-            with open ("contig_gff/"+contig+"_tmp1.gff","w") as contigGff:
+            for line in gffFile:
+                if line.startswith("#"):
+                    if line.startswith("##FASTA"):
+                        break
+                    if not line.startswith("##sequence-region"):
+                        continue
+                    values = line.split()
+                    contig = values[1] if len(values) > 1 else ""
+                else:
+                    contig = line[:line.find("\t")]
+                    feature = tallyFeature(line)
+                    if feature is not None and feature not in seen:
+                        seen.add(feature)
+                        features.append([contig, feature[0], feature[1]])
+                    line = addInfoToLine(line)
+                if contig not in unitOf:
+                    continue
+                if contig != current and not line.startswith("#"):
+                    if current is not None:
+                        passed.add(current)
+                        remaining[unitOf[current]] -= 1
+                        if grouped and remaining[unitOf[current]] == 0:
+                            unit = unitOf[current]
+                            if unit in openGffs:
+                                openGffs.pop(unit).close()
+                            reported.add(unit)
+                            ready(unit)
+                    if contig in passed:
+                        grouped = False #not grouped by contig
+                    current = contig
+                if unitOf[contig] in reported:
+                    grouped = False
+                    reported.remove(unitOf[contig]) #is given to ready again at the end
+                getContigGffHandle(unitOf[contig], openGffs, started).write(line)
+    finally:
+        for handle in openGffs.values():
+            handle.close()
+
+    #contigs without annotations still get a gff so that every contig has an embl
+    for contig in contigNames:
+        if contig not in started:
+            with open(scratch_dir+"/contig_gff/"+contig+".gff","w") as contigGff:
                 contigGff.write("##gff-version 3\n")
-                for line in gffFile:
-                    if (line.find(contig) != -1):
-                        contigGff.write(line)
-        
-        addInfoToGff(contig, "contig_gff/"+contig+"_tmp1.gff")
-        subprocess.call(["rm","contig_gff/"+contig+"_tmp1.gff"])
+    if ready is not None:
+        for contig in contigNames:
+            if contig not in reported:
+                ready(contig)
+    return features
+
+#feature types counted in the transfer stats, followed by the row for their total
+STAT_FEATURES = ["CDS","exon","gene","mRNA","tRNA","ncRNA","rRNA"]
+TOTAL_ROW = "total features"
+
+#table of the reference features counted in the transfer stats, written by the split so it survives a resume
+#relative to scratch_dir
+REFERENCE_FEATURES = "contig_gff/features.tsv"
+
+#returns the (type, ID) of a gff feature line if its type is counted in the transfer stats, otherwise None
+#called by splitGff and addToGenomicGff
+def tallyFeature(line):
+    values = line.split("\t")
+    if len(values) != 9 or values[2] not in STAT_FEATURES:
+        return None
+    return values[2], getID(values[8])
+
+#writes the [contig, type, ID] of each reference feature as a tab-delimited table
+#called by splitGenomicFiles
+def writeReferenceFeatures(features):
+    with open(scratch_dir+"/"+REFERENCE_FEATURES, "w") as table:
+        for feature in features:
+            table.write("\t".join(feature)+"\n")
+
+#reads the reference feature table back as a list of [contig, type, ID] in the order of the genomic gff
+#called by transferToQuery
+def readReferenceFeatures():
+    with open(scratch_dir+"/"+REFERENCE_FEATURES) as table:
+        return [line.rstrip("\n").split("\t") for line in table]
 
 #adds ncRNA_class attribute to ncRNA features
 #adds notes that include the original parents
-#called by main        
-def addInfoToGff(contig, gff):
-    print "\n<RATTwithGFF.py> adding ncRNA_class=other to "+contig+".gff"
-    output = 'contig_gff/'+contig+".gff"
-    with open(gff) as gffFile:
-        with open(output, "w") as outputFile:
-            for line in gffFile:
-                #adds ncRNA_class attribute to ncRNA
-                if( line.find("\tncRNA\t") != -1 and line.find("ncRNA_class") == -1 ):
-                    line = line[:len(line)-1]
-                    line = line + ";ncRNA_class=other\n"
-                #adds the parent attribute as a note
-                #this makes sure the parent attribute isn't removed during file conversions
-                if( line.find("Parent=") >=0 ):
-                    line = line[:len(line)-1]
-                    parent = line[line.find("Parent=")+7:]
-                    if ( parent.find(";") != -1):
-                        parent = parent[:parent.find(";")]
-                    else:
-                        parent = parent[:len(parent)]
-                    line = line + ";note=Parent:"+parent+"\n"
-                outputFile.write(line)
-
-#calls EMBLmyGFF3.py to convert the contig gff to an embl file
-#called by main
-def gffsToEmbls(contigNames):
+#called by splitGff
+def addInfoToLine(line):
+    #adds ncRNA_class attribute to ncRNA
+    if( line.find("\tncRNA\t") != -1 and line.find("ncRNA_class") == -1 ):
+        line = line.rstrip("\n")
+        line = line + ";ncRNA_class=other\n"
+    #adds the parent attribute as a note
+    #this makes sure the parent attribute isn't removed during file conversions
+    if( line.find("Parent=") >=0 ):
+        line = line.rstrip("\n")
+        parent = line[line.find("Parent=")+7:]
+        if ( parent.find(";") != -1):
+            parent = parent[:parent.find(";")]
+        line = line + ";note=Parent:"+parent+"\n"
+    return line
+
+#version of the embl files made by writeEmbl and cleanEmbl
+#part of the embl cache key, increase it when their output changes so old cache entries are not reused
+EMBL_CACHE_VERSION = 2
+
+#default location and size limit (in MB) of the embl cache shared by all runs
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "RATTwithGFF", "embl")
+DEFAULT_CACHE_SIZE = 2048
+
+#opens the persistent cache of contig embls
+#the converter name and version are part of the cache key, EMBLmyGFF3 is asked for its version
+#returns None if the cache is disabled or can not be used
+#called by runTransfer
+def openEmblCache(cacheDir, sizeLimit, useEMBLmyGFF3=False):
+    if cacheDir is None:
+        return None
+    converter = "native"
+    if useEMBLmyGFF3:
+        version = ""
+        try:
+            process = subprocess.Popen(["EMBLmyGFF3","--version"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            version = process.communicate()[0].strip()
+            if process.returncode != 0:
+                version = ""
+        except OSError:
+            pass
+        if not version:
+            sys.stderr.write("<RATTwithGFF.py> WARNING: could not get the EMBLmyGFF3 version, the embl cache is not used\n")
+            return None
+        converter = "EMBLmyGFF3 "+version
+    try:
+        makeDirectory(cacheDir)
+    except OSError as e:
+        sys.stderr.write("<RATTwithGFF.py> WARNING: could not create the embl cache "+cacheDir+" ("+str(e)+"), the embl cache is not used\n")
+        return None
+    return {"dir":cacheDir, "limit":sizeLimit*1024*1024, "converter":converter, "hits":0, "misses":0}
+
+#returns the cache key of a contig embl
+#the key is the md5 of the converter, the contig name, the contig gff and the contig fasta
+#called by convertContig
+def emblCacheKey(contig, converter):
+    md5 = hashlib.md5()
+    md5.update(str(EMBL_CACHE_VERSION)+"\t"+converter+"\t"+contig+"\n")
+    for fileName in contigInputs(contig):
+        md5.update(str(os.path.getsize(fileName))+"\n") #keeps the boundary between the two files
+        with open(fileName, "rb") as file:
+            block = file.read(IO_BLOCK_SIZE)
+            while block:
+                md5.update(block)
+                block = file.read(IO_BLOCK_SIZE)
+    return md5.hexdigest()
+
+#returns the path of a cache entry, entries are spread over subdirectories named after the first two characters of the key
+#called by fetchCachedEmbl and storeCachedEmbl
+def cachedEmblPath(cacheDir, key):
+    return os.path.join(cacheDir, key[:2], key+".embl")
+
+#hard-links the cached embl to outFile, or copies it if the cache is on another file system
+#the modification time of the entry is updated so trimEmblCache knows it was used recently
+#returns False if the embl is not cached
+#called by convertContig
+def fetchCachedEmbl(cacheDir, key, outFile):
+    cached = cachedEmblPath(cacheDir, key)
+    try:
+        os.utime(cached, None)
+        try:
+            os.link(cached, outFile)
+        except OSError:
+            shutil.copyfile(cached, outFile)
+    except (IOError, OSError):
+        return False
+    return True
+
+#copies a converted embl into the cache
+#the copy is renamed into place so that other runs never read a partial entry
+#a cache that can not be written only costs a conversion in the next run, so errors are ignored
+#called by convertContig
+def storeCachedEmbl(cacheDir, key, emblFile):
+    cached = cachedEmblPath(cacheDir, key)
+    temp = cached+"."+str(os.getpid())+".tmp"
+    try:
+        makeDirectory(os.path.dirname(cached))
+        shutil.copyfile(emblFile, temp)
+        os.rename(temp, cached)
+    except (IOError, OSError):
+        pass
+
+#removes the least recently used entries until the cache is within its size limit
+#called by gffsToEmbls
+def trimEmblCache(cache):
+    entries = []
+    total = 0
+    for root, dirs, files in os.walk(cache["dir"]):
+        for name in files:
+            if not name.endswith(".embl"):
+                continue
+            try:
+                stat = os.stat(os.path.join(root, name))
+            except OSError:
+                continue #removed by another run
+            entries.append((stat.st_mtime, stat.st_size, os.path.join(root, name)))
+            total += stat.st_size
+    entries.sort()
+    for mtime, size, fileName in entries:
+        if total <= cache["limit"]:
+            break
+        try:
+            os.remove(fileName)
+        except OSError:
+            pass
+        total -= size
+
+#prints the number of contig embls that were taken from the cache and that had to be converted
+#called by runTransfer
+def printCacheStats(cache):
+    if cache is not None:
+        print "\n<RATTwithGFF.py> embl cache: "+str(cache["hits"])+" hits, "+str(cache["misses"])+" misses ("+cache["dir"]+")"
+
+#creates the state of the embl conversion of a run, the conversions are tasks of the scheduler
+#they are submitted by submitEmbl, most of them while the split is still writing the other contigs
+#called by runTransfer
+def newEmblConversion(scheduler, useEMBLmyGFF3=False, manifest=None, cache=None):
+    cacheInfo = None
+    if cache is not None:
+        cacheInfo = (cache["dir"], cache["converter"])
+    return {"scheduler":scheduler, "useEMBLmyGFF3":useEMBLmyGFF3, "manifest":manifest, "cache":cache,
+        "cacheInfo":cacheInfo, "options":{"emblmygff3":useEMBLmyGFF3}, "tasks":{}}
+
+#starts the conversion of a contig whose gff and fasta are complete, unless its embl is still valid according to the manifest
+#a contig that is submitted again (its gff grew after it was submitted) is converted again once the earlier conversion finished
+#EMBLmyGFF3 conversions are "tool" tasks, the built-in writer runs "cpu" tasks
+#called by splitGff (through splitGenomicFiles) and gffsToEmbls
+def submitEmbl(conversion, contig):
+    names = conversion["tasks"].setdefault(contig, [])
+    if getValidStep(conversion["manifest"], "embl/"+contig, contigInputs(contig), conversion["options"]) is not None:
+        if not names:
+            names.append(None)
+        return
+    name = "embl/"+contig+"#"+str(len(names))
+    needs = [names[-1]] if names and names[-1] is not None else []
+    names.append(name)
+    resource = "tool" if conversion["useEMBLmyGFF3"] else "cpu"
+    conversion["scheduler"].add(name, resource, convertContig, (contig, conversion["useEMBLmyGFF3"], conversion["cacheInfo"]), needs)
+
+#converts each contig gff to an embl file with the built-in embl writer (or EMBLmyGFF3.py if useEMBLmyGFF3 is True)
+#contigs not submitted during the split are submitted here, then the conversions are collected and logged in contig order
+#if keepGoing is False the first failed contig stops the conversion, otherwise failed contigs are skipped
+#contigs whose embl is still valid according to the manifest are not converted again
+#the other contigs are taken from the embl cache when it has them, new embls are added to the cache
+#called by runTransfer
+def gffsToEmbls(contigNames, conversion, keepGoing=False, telemetry=None):
+    failed = []
+    manifest = conversion["manifest"]
+    cache = conversion["cache"]
     for contig in contigNames:
-        print "\n<RATTwithGFF.py> converting "+contig+".gff to "+contig+".embl...."
-        subprocess.call(["EMBLmyGFF3",\
-                            "contig_gff/"+contig+".gff",\
-                            "contig_fasta/"+contig+".fa",\
-                            "-o", "contig_embl/"+contig+"_tmp1.embl",\
+        if contig not in conversion["tasks"]:
+            submitEmbl(conversion, contig)
+    skipped = len([contig for contig in contigNames if conversion["tasks"][contig][-1] is None])
+    if skipped:
+        print "\n<RATTwithGFF.py> "+str(skipped)+" contig embl(s) are up to date, skipping them..."
+    try:
+        for contig in contigNames:
+            names = [name for name in conversion["tasks"][contig] if name is not None]
+            for name in names[:-1]:
+                conversion["scheduler"].result(name) #made from an incomplete gff, replaced by the last conversion
+            if not names:
+                continue
+            (contig, error, stderr, cached), usage = conversion["scheduler"].result(names[-1])
+            recordUsage(telemetry, "contig", "embl/"+contig, usage)
+            if cached:
+                print "\n<RATTwithGFF.py> using cached embl for "+contig+"...."
+                cache["hits"] += 1
+            else:
+                print "\n<RATTwithGFF.py> converting "+contig+".gff to "+contig+".embl...."
+                if cache is not None:
+                    cache["misses"] += 1
+            if stderr:
+                with open(scratch_dir+"/contig_embl_logs/"+contig+".log","w") as logFile:
+                    logFile.write(stderr)
+            if error is None:
+                if conversion["useEMBLmyGFF3"] and not cached:
+                    print "\nfixing line-breaks for: "+contig+".embl...."
+                recordStep(manifest, "embl/"+contig, contigInputs(contig), [scratch_dir+"/contig_embl/"+contig+".embl"], conversion["options"])
+                continue
+
+            if manifest is not None:
+                manifest["steps"].pop("embl/"+contig, None)
+            sys.stderr.write("<RATTwithGFF.py> ERROR: could not convert "+contig+".gff: "+error+"\n")
+            if stderr:
+                sys.stderr.write(stderr)
+            if not keepGoing:
+                raise OSError("embl conversion failed for "+contig+": "+error)
+            failed.append(contig)
+    finally:
+        saveManifest(manifest)
+
+    if cache is not None:
+        trimEmblCache(cache)
+    if failed:
+        sys.stderr.write("<RATTwithGFF.py> WARNING: "+str(len(failed))+" contig(s) could not be converted and will not be transferred: "+", ".join(failed)+"\n")
+    return failed
+
+#returns the files a contig embl is made from
+#called by gffsToEmbls and writeContigEmbl
+def contigInputs(contig):
+    return [scratch_dir+"/contig_gff/"+contig+".gff", scratch_dir+"/contig_fasta/"+contig+".fa"]
+
+#converts a single contig gff to a cleaned embl file, or takes it from the embl cache
+#returns the contig, an error message (None on success), the stderr of EMBLmyGFF3 and whether the embl was cached
+#an unexpected exception of the conversion is returned as the error, with its traceback as the stderr
+#runs in a worker process when gffsToEmbls is given more than one job
+#called by gffsToEmbls
+def convertContig(task):
+    contig, useEMBLmyGFF3, cacheInfo = task
+    emblFile = scratch_dir+"/contig_embl/"+contig+".embl"
+    if os.path.lexists(emblFile):
+        os.remove(emblFile) #may be a hard link to a cache entry, which must not be overwritten
+    key = None
+    if cacheInfo is not None:
+        try:
+            key = emblCacheKey(contig, cacheInfo[1])
+        except (IOError, OSError) as e:
+            return contig, str(e), "", False
+        if fetchCachedEmbl(cacheInfo[0], key, emblFile):
+            return contig, None, "", True
+
+    try:
+        error, stderr = writeContigEmbl(contig, useEMBLmyGFF3)
+    except Exception as e: #fails only this contig, so --keep-going can skip it
+        error, stderr = "unexpected "+type(e).__name__+" ("+str(e)+")", traceback.format_exc()
+    if error is not None:
+        for partial in (emblFile, scratch_dir+"/contig_embl/"+contig+"_tmp1.embl"): #no partial embl is left in contig_embl
+            if os.path.lexists(partial):
+                os.remove(partial)
+    elif key is not None:
+        storeCachedEmbl(cacheInfo[0], key, emblFile)
+    return contig, error, stderr, False
+
+#converts a single contig gff to a cleaned embl file with the built-in writer or EMBLmyGFF3
+#returns an error message (None on success) and the stderr of EMBLmyGFF3
+#called by convertContig
+def writeContigEmbl(contig, useEMBLmyGFF3):
+    if not useEMBLmyGFF3:
+        try:
+            gff, fasta = contigInputs(contig)
+            writeEmbl(contig, gff, fasta, scratch_dir+"/contig_embl/"+contig+".embl")
+        except (IOError, OSError, ValueError) as e:
+            return str(e), ""
+        return None, ""
+
+    try:
+        process = subprocess.Popen(["EMBLmyGFF3",\
+                            scratch_dir+"/contig_gff/"+contig+".gff",\
+                            scratch_dir+"/contig_fasta/"+contig+".fa",\
+                            "-o", scratch_dir+"/contig_embl/"+contig+"_tmp1.embl",\
                             "-i", "tag",\
                             "-p", contig,\
                             "-s", "unknown",\
@@ -196,8 +1427,188 @@ def gffsToEmbls(contigNames):
                             "-a",contig,\
                             "--keep_duplicates",\
                             "-q",\
-                            "--shame"])
+                            "--shame"], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stderr = process.communicate()[1]
+    except OSError as e:
+        return "could not call EMBLmyGFF3 ("+str(e)+")", ""
+
+    if process.returncode != 0:
+        return "EMBLmyGFF3 exited with status "+str(process.returncode), stderr
+    try:
         cleanEmbl(contig)
+    except (IOError, OSError) as e:
+        return str(e), stderr
+    return None, stderr
+
+#gff feature types that are written to the embl files
+EMBL_FEATURES = ["gene", "mRNA", "CDS", "exon", "tRNA", "rRNA", "ncRNA"]
+
+#gff attributes that are written as embl qualifiers, ID is kept as a note so it can be traced after the transfer
+GFF_TO_EMBL_QUALIFIERS = {"Dbxref":"db_xref", "Name":"standard_name", "gene":"gene", "locus_tag":"locus_tag",
+    "product":"product", "protein_id":"protein_id", "ncRNA_class":"ncRNA_class", "note":"note"}
+
+#gff attributes that can hold several values separated by commas, each value is written as its own qualifier
+#the values of other attributes, such as a note, are free text that is kept whole
+MULTI_VALUE_ATTRIBUTES = set(["Parent", "Dbxref", "Ontology_term", "Alias"])
+
+#features whose location is the join of their exons when they have any
+EXON_PARENT_FEATURES = set(["mRNA", "tRNA", "rRNA", "ncRNA"])
+
+#writes an embl file for a contig directly from its gff and fasta
+#a packed fasta with several sequences gets one embl entry per sequence holding the features on that sequence
+#qualifiers and locations are written on a single line as RATT does not read wrapped lines
+#attributes without a value are left out
+#called by convertContig
+def writeEmbl(contig, gff, fasta, embl):
+    records = countFastaBases(fasta)
+    packed = len(records) > 1
+    features = collections.OrderedDict() #(seqid, type, ID) -> [type, strand, segments, attributes]
+    exons = {}
+    with open(gff) as gffFile:
+        for line in gffFile:
+            feature = parseGffLine(line)
+            if feature is None or feature.type not in EMBL_FEATURES:
+                continue
+            seqid = feature.seqid if packed else None
+            featureID = feature.getAttribute("ID")
+            key = (seqid, feature.type, featureID if featureID is not None else len(features))
+            segment = (feature.start, feature.end, feature.phase)
+            if key in features:
+                features[key][2].append(segment) #multi-line features, usually CDS
+            else:
+                features[key] = [feature.type, feature.strand, [segment], feature.attributes]
+            if feature.type == "exon":
+                for parent in (feature.getAttribute("Parent") or "").split(","):
+                    exons.setdefault((seqid, parent), []).append(segment)
+
+    with open(embl, "w") as emblFile, open(fasta) as fastaFile:
+        for name, length, baseCounts in records:
+            seqid = name if packed else None
+            name = name if packed else contig
+            emblFile.write("ID   XXX; XXX; linear; genomic DNA; STD; UNC; "+str(length)+" BP.\n")
+            emblFile.write("XX\nAC   XXX;\nXX\nAC * _"+name+"\nXX\nPR   Project:"+name+";\nXX\n")
+            emblFile.write("DE   XXX\nXX\nOS   unknown\nOC   unclassified sequences.\nXX\n")
+            emblFile.write("FH   Key             Location/Qualifiers\nFH\n")
+            writeEmblFeature(emblFile, "source", "1.."+str(length), ['/organism="unknown"', '/mol_type="genomic DNA"'])
+
+            for (featureSeqid, featureType, featureID), feature in features.iteritems():
+                if featureSeqid != seqid:
+                    continue
+                strand, segments, attributes = feature[1:]
+                if featureType in EXON_PARENT_FEATURES and (seqid, featureID) in exons:
+                    segments = exons[(seqid, featureID)]
+                qualifiers = []
+                for attribute, value in attributes:
+                    if value is None: #an attribute without a value has nothing to write
+                        continue
+                    if attribute == "ID":
+                        qualifiers.append('/note="ID:'+value+'"')
+                    elif attribute in GFF_TO_EMBL_QUALIFIERS:
+                        for x in (value.split(",") if attribute in MULTI_VALUE_ATTRIBUTES else [value]):
+                            qualifiers.append('/'+GFF_TO_EMBL_QUALIFIERS[attribute]+'="'+unescapeGff(x).replace('"','""')+'"')
+                if featureType == "CDS":
+                    ordered = sorted(segments, reverse=(strand == "-"))
+                    phase = ordered[0][2]
+                    qualifiers.append("/codon_start="+str(int(phase)+1 if phase.isdigit() else 1))
+                    qualifiers.append("/transl_table=1")
+                writeEmblFeature(emblFile, featureType, makeEmblLocation(segments, strand), qualifiers)
+
+            emblFile.write("XX\n")
+            emblFile.write("SQ   Sequence "+str(length)+" BP; "+str(baseCounts[0])+" A; "+str(baseCounts[1])+" C; "+
+                str(baseCounts[2])+" G; "+str(baseCounts[3])+" T; "+str(baseCounts[4])+" other;\n")
+            writeEmblSequence(emblFile, fastaFile, length)
+            emblFile.write("//\n")
+
+#writes one embl feature with each qualifier on its own unwrapped line
+#called by writeEmbl
+def writeEmblFeature(emblFile, key, location, qualifiers):
+    emblFile.write("FT   "+key.ljust(16)+location+"\n")
+    for qualifier in qualifiers:
+        emblFile.write("FT                   "+qualifier+"\n")
+
+#converts gff segments into an embl location, joined when there are several and complemented on the - strand
+#called by writeEmbl
+def makeEmblLocation(segments, strand):
+    parts = [str(start)+".."+str(end) for start, end, phase in sorted(set(segments))]
+    location = ",".join(parts)
+    if len(parts) > 1:
+        location = "join("+location+")"
+    if strand == "-":
+        location = "complement("+location+")"
+    return location
+
+#splits a gff attribute column into a list of (name, value) pairs
+#attributes without a value are kept with None as the value
+#called by parseGffLine
+def parseAttributes(column):
+    attributes = []
+    for attribute in column.strip().split(";"):
+        name, equals, value = attribute.partition("=")
+        if equals:
+            attributes.append((name, value))
+        elif attribute:
+            attributes.append((attribute, None))
+    return attributes
+
+#decodes the %XX escapes used in gff attribute values
+#called by writeEmbl
+def unescapeGff(value):
+    if value.find("%") == -1:
+        return value
+    return urllib.unquote(value)
+
+#counts the length and the A, C, G, T and other bases of each sequence in a fasta
+#returns a list of (name, length, counts) in the order of the fasta
+#called by writeEmbl
+def countFastaBases(fasta):
+    records = []
+    counts = None
+    with open(fasta) as fastaFile:
+        for line in fastaFile:
+            if line.startswith(">"):
+                counts = [0, 0, 0, 0, 0]
+                records.append((line[1:].split()[0] if line[1:].strip() else "", counts))
+                continue
+            if counts is None: #sequence without a header, treated as one unnamed sequence
+                counts = [0, 0, 0, 0, 0]
+                records.append(("", counts))
+            line = line.rstrip("\r\n")
+            counts[4] += len(line)
+            for x, base in enumerate("ACGT"):
+                counts[x] += line.count(base) + line.count(base.lower())
+    if not records:
+        records.append(("", [0, 0, 0, 0, 0]))
+    return [(name, bases[4], bases[:4] + [bases[4] - sum(bases[:4])]) for name, bases in records]
+
+#copies the next sequence of an open fasta into the embl sequence format, stopping after length bases
+#lowercase, 60 bases per line in blocks of 10 followed by the position of the last base
+#called by writeEmbl
+def writeEmblSequence(emblFile, fastaFile, length):
+    position = 0
+    leftover = ""
+    read = 0
+    while read < length:
+        line = fastaFile.readline()
+        if not line:
+            break
+        if line.startswith(">"):
+            continue
+        line = line.rstrip("\r\n")
+        read += len(line)
+        bases = leftover + line.lower()
+        full = len(bases) - len(bases)%60
+        for x in xrange(0, full, 60):
+            position += 60
+            emblFile.write(formatEmblSequenceLine(bases[x:x+60], position))
+        leftover = bases[full:]
+    if leftover:
+        emblFile.write(formatEmblSequenceLine(leftover, position+len(leftover)))
+
+#formats up to 60 bases as one line of an embl sequence
+#called by writeEmblSequence
+def formatEmblSequenceLine(bases, position):
+    blocks = " ".join([bases[x:x+10] for x in xrange(0, len(bases), 10)])
+    return "     "+blocks.ljust(66)+str(position).rjust(9)+"\n"
 
 #checks if str2 is found in str1
 #called by isBrokenLine
@@ -222,137 +1633,905 @@ def combineLines(line1,line2):
     second = line2[21:]
     return (first+second)
 
-#checks if a value is in a list
-#called by fixBrokenLines
-def isInList(val,alist):
-    for i in alist:
-        if( i == val ):
-            return True
-    return False
-
 #checks an embl file for lines that are wrapped/broken
 #takes the wrapped line and adds it to the line above
 #this is necessary as RATT does not recognize the wrapped line as being a part of the line above
+#streams the file in one pass, only the line that is being rebuilt is kept in memory
 #called by cleanEmbl
-def fixBrokenLines(fileName):
-    toRemove = []
-    fixedLines = []
+def fixBrokenLines(fileName, outFile):
+    pending = None #last line read that is not wrapped, with any wrapped lines below it added
     with open(fileName) as file:
-        lines = file.readlines()
-        for x in range(len(lines)-1,-1,-1): #starts from last line and moves up ##necessary to fix lines broken into 3+ lines
-            if isBrokenLine(lines[x]):
-                lines[x-1] = combineLines(lines[x-1], lines[x])
-                toRemove.append(x) #keeps track of lines to be removed
-    for i in range(0,len(lines)):
-        if( isInList(i, toRemove) == False):
-            fixedLines.append(lines[i])
-    return fixedLines
+        for line in file:
+            if pending is not None and isBrokenLine(line):
+                pending = combineLines(pending, line)
+                continue
+            if pending is not None:
+                outFile.write(pending)
+            pending = line
+    if pending is not None:
+        outFile.write(pending)
 
 #fixes broken/wrapped lines in the embl files for each contig and writes to new file
-#called by gffsToEmbls
+#called by convertContig
 def cleanEmbl(contig):
-    print "\nfixing line-breaks for: "+contig+".embl...."
-    embl = "contig_embl/"+contig+"_tmp1.embl"
-    cleanEmblLines = fixBrokenLines(embl)
-    with open("contig_embl/"+contig+".embl","w") as outputFile:
-        for line in cleanEmblLines:
-            outputFile.write(line)
-
-    subprocess.call(["rm",embl])
-
-#calls the RATT script to transfer the annotations
-#also creates directories to organize the RATT output files
-#called by main
-def runRatt(subFa,queryFa, sampleID, parameter):
-    print "\n<RATTwithGFF.py>***RUNNING QUAST on both sequences....."
-    subprocess.call(["mkdir",ratt_dir]) #makes directory where the ratt results are stored
+    embl = scratch_dir+"/contig_embl/"+contig+"_tmp1.embl"
+    with open(scratch_dir+"/contig_embl/"+contig+".embl","w") as outputFile:
+        fixBrokenLines(embl, outputFile)
+
+    os.remove(embl)
+
+#starts QUAST on a fasta in the background, the report is written to outDir
+#returns the QUAST process and its start time, or None if the report is up to date or QUAST could not be called
+#called by runTransfer and transferToQuery
+def startQuast(fasta, outDir, step, manifest=None):
+    if getValidStep(manifest, step, [fasta], {}) is not None:
+        print "\n<RATTwithGFF.py> QUAST report for "+fasta+" is up to date, skipping QUAST..."
+        return None
+    print "\n<RATTwithGFF.py>***RUNNING QUAST on "+fasta+" in the background....."
     try:
-        subprocess.call(["quast.py","-o",ratt_dir+"/ref_quast","--fast","-s","--silent",subFa])
-        subprocess.call(["quast.py","-o",ratt_dir+"/query_quast","--fast","-s","--silent",queryFa])
+        return subprocess.Popen(["quast.py","-o",outDir,"--fast","-s","--silent",fasta]), timeit.default_timer()
     except OSError:
         sys.stderr.write("***********************************************************************************\n")
         sys.stderr.write("<RATTwithGFF.py> ERROR\n")
         sys.stderr.write("OSError: Could not call QUAST, Check that it is installed correctly\n")
         sys.stderr.write("***********************************************************************************\n")
-#         return False
+        return None
+
+#waits for a QUAST process started by startQuast and records its report in the manifest
+#called by runTransfer and transferToQuery
+def finishQuast(quast, fasta, outDir, step, manifest=None, telemetry=None):
+    if quast is None:
+        return
+    if waitForCommand(quast[0], quast[1], telemetry, step) == 0 and os.path.isfile(outDir+"/report.tsv"):
+        recordStep(manifest, step, [fasta], [outDir+"/report.tsv"], {})
+        saveManifest(manifest)
+    else:
+        sys.stderr.write("<RATTwithGFF.py> WARNING: QUAST could not make a report for "+fasta+"\n")
+
+#transfers the annotations to one query: runs QUAST on the query, RATT on the contig embls and processes the RATT results
+#the results are written to ratt_dir, the features of the genomic gff are also added to records unless it is None
+#the reference features are read from the table made by the split unless the split handed them over
+#returns the transfer stats made by makeTransferStats, or None if RATT or the result processing failed
+#called by runTransfer and batchQuery
+def transferToQuery(embls, queryFasta, runID, rattType, gff, args, refStats, manifest=None, telemetry=None, refFeatures=None, records=None):
+    quast = None
+    if args.quast:
+        quast = startQuast(queryFasta, ratt_dir+"/query_quast", "quast/query", manifest) #overlaps with RATT
+    transferred = {} #final features counted while genomic.final.gff is written
+    worked = runStage(telemetry, "ratt", runRatt, embls, queryFasta, runID, rattType, manifest, telemetry, args.rattShards) and \
+        runStage(telemetry, "results", processRattResults, gff, args.jobs, args.seqret, manifest, telemetry, transferred,
+            not args.noContigGffs, args.bgzip, args.memoryLimit, records)
+    stats = None
+    if worked:
+        queryStats = runStage(telemetry, "stats/query", assemblyStats, queryFasta)
+        if refFeatures is None:
+            refFeatures = readReferenceFeatures()
+        stats = runStage(telemetry, "stats/transfer", makeTransferStats, refFeatures, transferred, refStats, queryStats)
+    finishQuast(quast, queryFasta, ratt_dir+"/query_quast", "quast/query", manifest, telemetry)
+    writeTelemetry(telemetry)
+    return stats
+
+#transfers the annotations to every query of a batch, each query in its own process and <run-ID>_RATT directory
+#at most args.maxQueries queries are transferred at the same time
+#the messages of each query are written to <run-ID>_RATT/<run-ID>.log
+#returns the run-IDs of the queries that were transferred, in the order of the query list
+#called by runTransfer
+def runBatch(queries, embls, gff, rattType, args, refStats):
+    pending = list(queries)
+    running = []
+    failed = set()
+    while pending or running:
+        while pending and len(running) < args.maxQueries:
+            queryFasta, runID = pending.pop(0)
+            print "\n<RATTwithGFF.py> transferring annotations to "+queryFasta+" (log: "+runID+"_RATT/"+runID+".log)..."
+            sys.stdout.flush()
+            process = multiprocessing.Process(target=batchQuery, args=((embls, queryFasta, runID, rattType, gff, args, refStats),))
+            process.start()
+            running.append((runID, process))
+        running[0][1].join(1)
+        for runID, process in list(running):
+            if process.is_alive():
+                continue
+            running.remove((runID, process))
+            if process.exitcode == 0:
+                print "\n<RATTwithGFF.py> finished "+runID
+            else:
+                sys.stderr.write("<RATTwithGFF.py> ERROR: the transfer to "+runID+" failed, see "+runID+"_RATT/"+runID+".log\n")
+                failed.add(runID)
+    if failed:
+        sys.stderr.write("<RATTwithGFF.py> WARNING: "+str(len(failed))+" of "+str(len(queries))+" queries could not be transferred: "+", ".join(sorted(failed))+"\n")
+    return [query[1] for query in queries if query[1] not in failed]
+
+#transfers the annotations to a single query of a batch
+#runs in its own process so that ratt_dir and the query's manifest are not shared with the other queries
+#exits with status 1 if the transfer failed
+#called by runBatch
+def batchQuery(task):
+    embls, queryFasta, runID, rattType, gff, args, refStats = task
+    global ratt_dir
+    ratt_dir = runID+"_RATT"
+    makeDirectory(ratt_dir)
+    with open(ratt_dir+"/"+runID+".log", "w") as logFile:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(logFile.fileno(), 1) #QUAST and RATT write to the same log
+        os.dup2(logFile.fileno(), 2)
+    manifest = loadManifest(ratt_dir, args.forceStages)
+    if not transferToQuery(embls, queryFasta, runID, rattType, gff, args, refStats, manifest, newTelemetry(args.profile)):
+        sys.exit(1)
+    printTransferStats()
+
+#patterns of the RATT output files and the subdirectory of the RATT directory each is moved to
+#a file is moved by the first pattern it matches
+RATT_OUTPUT_PATTERNS = [("*.final.embl", "final_embl"), ("*.Report.gff", "Report_gff"), ("*.Report.txt", "Report_txt"),
+    ("*.NOTTransfered.embl", "NOTTransfered_embl"), ("nucmer.*", "nucmer"), ("*tmp2.embl", "tmp2_embl"), ("*.embl", "uncorrected_embl")]
+
+#moves the RATT output files from its working directory into the subdirectories of ratt_dir
+#hidden files are left alone, as the shell globs this replaces did
+#with shard the output of one shard of a sharded run is added to the outputs of the shards before it, see mergeRattOutput
+#called by runRatt
+def sortRattOutput(rattWork, shard=None):
+    for fileName in sorted(os.listdir(rattWork)):
+        if fileName.startswith("."):
+            continue
+        for pattern, subdir in RATT_OUTPUT_PATTERNS:
+            if fnmatch.fnmatchcase(fileName, pattern):
+                target = ratt_dir+"/"+subdir+"/"+fileName
+                if shard is not None and subdir == "nucmer":
+                    target = ratt_dir+"/nucmer/"+fileName.replace("nucmer.", "nucmer.shard"+str(shard)+".", 1) #every shard aligns with the same names
+                if os.path.isdir(target):
+                    shutil.rmtree(target)
+                elif shard is not None and os.path.isfile(target):
+                    mergeRattOutput(rattWork+"/"+fileName, target, subdir)
+                    break
+                shutil.move(rattWork+"/"+fileName, target) #a rename unless scratch is on another file system
+                break
+
+#adds a RATT output file of a shard to the file of the same name written by an earlier shard
+#the embls are named by query sequence, every shard can transfer features to the same one
+#embls get the features of the shard added to their feature table, gffs their feature lines and other files are appended
+#called by sortRattOutput
+def mergeRattOutput(source, target, subdir):
+    if subdir.endswith("_embl"):
+        mergeEmblFeatures(source, target)
+    else:
+        with open(source) as sourceFile, open(target, "a") as targetFile:
+            for line in sourceFile:
+                if subdir != "Report_gff" or not line.startswith("#"):
+                    targetFile.write(line)
+    os.remove(source)
+
+#adds the features of the source embl, except its 'source' feature, to the end of the feature table of the target embl
+#both are embls of the same query sequence with one entry, as RATT writes them
+#only the feature table of the source is kept in memory, the target is streamed into a new file that replaces it
+#called by mergeRattOutput
+def mergeEmblFeatures(source, target):
+    features = []
+    with open(source) as sourceFile:
+        keep = False
+        for line in sourceFile:
+            if line.startswith("FT"):
+                if line[5:21].strip():
+                    keep = line[5:21].strip() != "source"
+                if keep:
+                    features.append(line)
+            elif line.startswith("SQ"):
+                break
+    if not features:
+        return
+    with open(target) as targetFile, open(target+".merge", "w") as merged:
+        added = False
+        inTable = False
+        for line in targetFile:
+            if not added and (line.startswith("SQ") or line.startswith("//") or (inTable and not line.startswith("FT"))):
+                merged.writelines(features)
+                added = True
+            inTable = line.startswith("FT")
+            merged.write(line)
+        if not added:
+            merged.writelines(features)
+    os.rename(target+".merge", target)
+
+#returns the total length of the sequences of an embl from the lengths in its ID lines
+#an embl with an entry without a length in its ID line is weighed by its file size instead
+#called by shardEmbls
+def emblTotalLength(fileName):
+    total = 0
+    with open(fileName) as emblFile:
+        for line in emblFile:
+            if line.startswith("ID"):
+                match = EMBL_LENGTH.search(line)
+                if not match:
+                    return os.path.getsize(fileName)
+                total += int(match.group(1))
+    return total
+
+#splits the contig embls into at most 'shards' shards of about the same total sequence length
+#the longest embls are placed first, each in the shard with the shortest total so far
+#returns the list of embls of each shard, without empty shards
+#called by runRatt
+def shardEmbls(embls, shards):
+    lengths = dict((embl, emblTotalLength(embl)) for embl in embls)
+    totals = [0]*min(shards, len(embls))
+    members = [[] for x in totals]
+    for embl in sorted(embls, key=lambda embl: (-lengths[embl], embl)):
+        smallest = totals.index(min(totals))
+        totals[smallest] += lengths[embl]
+        members[smallest].append(embl)
+    return [sorted(shard) for shard in members]
+
+#subdirectories of the RATT directory that the RATT output files are sorted into
+RATT_SUBDIRS = ["final_embl","Report_gff","Report_txt","NOTTransfered_embl","nucmer","tmp2_embl","uncorrected_embl","final_gff"]
+
+#calls the RATT script to transfer the annotations of the contig embls
+#RATT runs in its own directory in scratch_dir on a directory of links to the embls, so contigs that could not be
+#converted (see gffsToEmbls) are left out, its output files are then moved into subdirectories of ratt_dir
+#with more than one shard the contig embls are split by shardEmbls and a RATT runs on each shard at the same time,
+#each in its own directory with links to the embls of the shard, and their outputs are merged by sortRattOutput
+#skipped when the manifest shows RATT already ran on the same embls, query and parameters
+#called by transferToQuery
+def runRatt(embls, queryFa, sampleID, parameter, manifest=None, telemetry=None, shards=1):
+    inputs = sorted(embls)
+    inputs.append(queryFa)
+    options = {"sampleID":sampleID, "rattType":parameter}
+    if getValidStep(manifest, "ratt", inputs, options) is not None:
+        print "\n<RATTwithGFF.py> RATT results are up to date, skipping RATT..."
+        return True
+
+    #results of an earlier run would be mixed with the new ones
+    if manifest is not None:
+        invalidateStage(manifest, "ratt")
+        invalidateStage(manifest, "results")
+        saveManifest(manifest)
+    for subdir in RATT_SUBDIRS:
+        if os.path.isdir(ratt_dir+"/"+subdir):
+            shutil.rmtree(ratt_dir+"/"+subdir)
+    rattWork = scratch_dir+"/ratt_"+sampleID #RATT writes many small files, left behind from an earlier run they would be moved as well
+    if os.path.isdir(rattWork):
+        shutil.rmtree(rattWork)
+    makeDirectory(rattWork)
+
+    #each RATT gets a directory of links to its embls and a working directory
+    runs = [(rattWork+"/embl", rattWork+"/work", None, inputs[:-1])]
+    if shards > 1 and len(inputs) > 2:
+        runs = []
+        for shard, shardInputs in enumerate(shardEmbls(inputs[:-1], shards), 1):
+            runs.append((rattWork+"/shard"+str(shard)+"_embl", rattWork+"/shard"+str(shard), shard, shardInputs))
+        print "\n<RATTwithGFF.py> running RATT on "+str(len(runs))+" shards of the contig embls"
+    for emblDir, workDir, shard, runInputs in runs:
+        makeDirectory(emblDir)
+        makeDirectory(workDir)
+        for embl in runInputs:
+            os.symlink(os.path.abspath(embl), emblDir+"/"+os.path.basename(embl))
 
     print "\n<RATTwithGFF.py>***RUNNING RATT....."
+    processes = []
     try:
-        subprocess.call(["start.ratt.sh","../contig_embl","../"+queryFa, sampleID, parameter],cwd=ratt_dir)
+        started = timeit.default_timer()
+        for emblDir, workDir, shard, runInputs in runs:
+            processes.append(subprocess.Popen(["start.ratt.sh",os.path.abspath(emblDir),os.path.abspath(queryFa), sampleID, parameter],cwd=workDir))
     except OSError:
+        for process in processes:
+            process.kill()
+            process.wait()
         sys.stderr.write("***********************************************************************************\n")
         sys.stderr.write("<RATTwithGFF.py> FATAL-ERROR\n")
         sys.stderr.write("OSError: could not call RATT, check that RATT is installed correctly\n")
         sys.stderr.write("***********************************************************************************\n")
         return False
+    for process, (emblDir, workDir, shard, runInputs) in zip(processes, runs):
+        waitForCommand(process, started, telemetry, "start.ratt.sh" if shard is None else "start.ratt.sh/shard"+str(shard))
     
-    subprocess.call(["mkdir","final_embl","Report_gff","Report_txt","NOTTransfered_embl","nucmer","tmp2_embl","uncorrected_embl","final_gff"],cwd=ratt_dir)
-    subprocess.call(["mv *.final.embl final_embl"], shell=True, cwd=ratt_dir)
-    subprocess.call(["mv *.Report.gff Report_gff"], shell=True, cwd=ratt_dir)
-    subprocess.call(["mv *.Report.txt Report_txt"], shell=True, cwd=ratt_dir)
-    subprocess.call(["mv *.NOTTransfered.embl NOTTransfered_embl"], shell=True, cwd=ratt_dir)
-    subprocess.call(["mv nucmer.* nucmer"], shell=True, cwd=ratt_dir)
-    subprocess.call(["mv *tmp2.embl tmp2_embl"], shell=True, cwd=ratt_dir)
-    subprocess.call(["mv *.embl uncorrected_embl"], shell=True, cwd=ratt_dir)
+    for subdir in RATT_SUBDIRS:
+        makeDirectory(ratt_dir+"/"+subdir)
+    for emblDir, workDir, shard, runInputs in runs:
+        sortRattOutput(workDir, shard)
+
+    outputs = []
+    for subdir in RATT_SUBDIRS[:-1]: #final_gff is written by processRattResults
+        for fileName in sorted(os.listdir(ratt_dir+"/"+subdir)):
+            outputs.append(ratt_dir+"/"+subdir+"/"+fileName)
+    if os.listdir(ratt_dir+"/final_embl"):
+        recordStep(manifest, "ratt", inputs, outputs, options)
+        saveManifest(manifest)
     return True
 
-
-#converts the RATT results from EMBL to gff using EMBOSS seqret
+#converts the RATT results from EMBL to gff with the built-in embl reader (or EMBOSS seqret if useSeqret is True)
 #fixes the errors that emberge due to the conversion
 #generates a new genomic gff by combining the annotations from all contigs
-#calculates the transfer stats for each feature
-def processRattResults(origGff):
+#contigs are processed by a pool of 'jobs' worker processes and streamed into the genomic gff in their original order
+#with contigGffs each contig gff is also written to final_gff, and the ones still valid according to the manifest are reused
+#with one job each gene group is written to the genomic gff (and the contig gff) as soon as it is fixed, a worker instead
+#writes the contig gff, or only the fixed features to a temp file in scratch_dir, which is then added to the genomic gff
+#with bgzip a sorted, bgzip compressed copy of the genomic gff is written with a tabix index, see writeBgzipGff
+#the features of the genomic gff are also added to records as GffFeatures unless it is None
+def processRattResults(origGff, jobs=1, useSeqret=False, manifest=None, telemetry=None, transferred=None, contigGffs=True, bgzip=False,
+    memoryLimit=0, records=None):
     print "\n<RATTwithGFF.py> processing RATT results..."
     genomicGff = ratt_dir+"/final_gff/genomic.final.gff"
-    with open(genomicGff,"w") as genomic:
-        genomic.write("##gff-version 3\n")
-
-    embls = subprocess.check_output(["ls", ratt_dir+"/final_embl"]).splitlines()
+    embls = sorted(os.listdir(ratt_dir+"/final_embl"))
+    options = {"seqret":useSeqret}
+    tasks = []
+    upToDate = set()
     for embl in embls:
-        outFile = ratt_dir+"/final_gff/"+embl[:embl.find(".embl")]+".gff"
-        temp = "temp01.gff"
+        if contigGffs and getValidStep(manifest, "results/"+embl, [ratt_dir+"/final_embl/"+embl], options) is not None:
+            upToDate.add(embl)
+        else:
+            tasks.append((embl, useSeqret, contigGffs, memoryLimit))
+    if upToDate:
+        print "\n<RATTwithGFF.py> "+str(len(upToDate))+" result gff(s) are up to date, skipping them..."
+    pool = None
+    if jobs > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(min(jobs, len(tasks)))
+    sortedLines = collections.OrderedDict() if bgzip else None
+    try:
+        with open(genomicGff,"w") as genomic:
+            genomic.write("##gff-version 3\n")
+            if pool is not None:
+                results = pool.imap(timedTask, [(processRattEmbl, task+(None,)) for task in tasks]) #imap returns results in the order of embls
+            else:
+                stream = lambda task: (processRattEmbl, task+(GenomicGffStream(genomic, transferred, sortedLines, records),))
+                results = itertools.imap(timedTask, itertools.imap(stream, tasks))
+            for embl in embls:
+                if embl in upToDate:
+                    print "\nadding: "+ratt_dir+"/final_gff/"+embl[:embl.find(".embl")]+".gff annotations to: "+genomicGff
+                    with open(ratt_dir+"/final_gff/"+embl[:embl.find(".embl")]+".gff") as contigGff:
+                        addToGenomicGff(contigGff, genomic, transferred, sortedLines, records)
+                    continue
+                (embl, outFile, worked, featureFile), usage = next(results)
+                recordUsage(telemetry, "contig", "results/"+embl, usage)
+                print "\n<RATTwithGFF.py> converting: "+ratt_dir+"/final_embl/"+embl+" to gff..."
+                if not worked:
+                    sys.stderr.write("***********************************************************************************\n")
+                    sys.stderr.write("<RATTwithGFF.py> FATAL-ERROR\n")
+                    sys.stderr.write("OSError: Could not call EMBOSS seqret, make sure EMBOSS is installed correctly\n")
+                    sys.stderr.write("***********************************************************************************\n")
+                    return False
+                print "\n<RATTwithGFF.py> Fixing embl-gff conversion errors in: "+outFile
+                if contigGffs:
+                    recordStep(manifest, "results/"+embl, [ratt_dir+"/final_embl/"+embl], [outFile], options)
+                print "\nadding: "+embl+" annotations to: "+genomicGff
+                if pool is None:
+                    continue #already streamed into the genomic gff
+                with open(outFile if featureFile is None else featureFile) as contigGff:
+                    addToGenomicGff(contigGff, genomic, transferred, sortedLines, records)
+                if featureFile is not None:
+                    os.remove(featureFile)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        saveManifest(manifest)
+
+    if bgzip:
+        print "\n<RATTwithGFF.py> writing sorted and bgzip compressed "+genomicGff+".gz..."
+        writeBgzipGff(sortedLines, genomicGff+".gz")
+    return True
+
+#converts a single RATT embl to gff and fixes the conversion errors
+#the seqret output is written to a temp file named after the embl so that contigs can be processed at the same time
+#the gff is streamed through fixGeneGroups, so only one gene group is held in memory at a time
+#returns the embl, the fixed gff, False if seqret could not be called and the temp file of the fixed features
+#with a GenomicGffStream each gene group is written straight to the genomic gff, and to final_gff when contigGff is True
+#otherwise the fixed gff is written to final_gff when contigGff is True and the temp file is None, or only the
+#features are written, to a temp file in scratch_dir that processRattResults adds to the genomic gff
+#runs in a worker process, without a GenomicGffStream, when processRattResults is given more than one job
+#called by processRattResults
+def processRattEmbl(task):
+    embl, useSeqret, contigGff, memoryLimit, genomic = task
+    name = embl[:embl.find(".embl")]
+    outFile = ratt_dir+"/final_gff/"+name+".gff"
+    temp = None
+    if not useSeqret:
+        gffLines = readEmbl(ratt_dir+"/final_embl/"+embl, rattContigName(embl))
+        links = newGroupLinks(emblParentIDs(ratt_dir+"/final_embl/"+embl))
+        fixGroup = None #readEmbl already numbers the IDs and writes the attributes of the final gff
+    else:
+        temp = scratch_dir+"/"+name+".seqret.tmp"
         try:
-            emblToGff(ratt_dir+"/final_embl/"+embl)
+            emblToGff(ratt_dir+"/final_embl/"+embl, temp)
         except OSError:
-            sys.stderr.write("***********************************************************************************\n")
-            sys.stderr.write("<RATTwithGFF.py> FATAL-ERROR\n")
-            sys.stderr.write("OSError: Could not call EMBOSS seqret, make sure EMBOSS is installed correctly\n")
-            sys.stderr.write("***********************************************************************************\n")
-            return False
-
-        print "\n<RATTwithGFF.py> Fixing embl-gff conversion errors in: "+outFile
+            return embl, outFile, False, None
         gffLines = parseGff(temp)
-        gffLines = fixBiologicalRegions(gffLines)
-        gffLines = cleanChromAndSource(gffLines)
-        gffLines = renumberIDs(gffLines)
-        gffLines = addAllParents(gffLines)
-        gffLines = fixCdsPhase(gffLines)
-        gffLines = cleanAttributes(gffLines)
-        gffLines = fixCdsPos(gffLines)
-        writeToFile(gffLines, outFile)
-        addToGenomicGff(outFile,genomicGff)
-    
-    makeTransferStats(origGff,genomicGff)
-    return True
+        links = newGroupLinks(gffParentIDs(temp))
+        numbering = {"count":0, "previous":None} #IDs are numbered on from one group to the next
+        fixGroup = lambda group: fixSeqretGroup(group, numbering)
+
+    featureFile = None
+    if genomic is not None and contigGff:
+        with open(outFile, "w") as gff:
+            genomic.contigGff = gff
+            fixGeneGroups(gffLines, fixGroup, genomic, links, memoryLimit, embl)
+    elif genomic is not None:
+        fixGeneGroups(gffLines, fixGroup, genomic, links, memoryLimit, embl, False)
+    elif contigGff:
+        with open(outFile, "w") as gff:
+            fixGeneGroups(gffLines, fixGroup, gff, links, memoryLimit, embl)
+    else:
+        featureFile = scratch_dir+"/"+name+".features.tmp"
+        with open(featureFile, "w") as gff:
+            fixGeneGroups(gffLines, fixGroup, gff, links, memoryLimit, embl, False) #the sequence is only needed in the contig gffs
+    if temp is not None:
+        os.remove(temp)
+    return embl, outFile, True, featureFile
+
+#fixes a gene group of the gff seqret made from a RATT embl, before it is linked by linkGroup
+#called by processRattEmbl
+def fixSeqretGroup(group, numbering):
+    group = fixBiologicalRegions(group)
+    group = cleanChromAndSource(group)
+    group = renumberIDs(group, numbering)
+    return cleanAttributes(group)
+
+# [ids]:new ID of each original ID (from 'note=ID:') of the parents linked so far
+# [mRNAs]:start and end of each mRNA parent linked so far, by its new ID
+# [children]:number of features not written yet that list each parent of the contig, by its original ID
+# [waiting]:features held back until the feature with the original ID they are listed under is linked
+#links the gene groups of a contig, so that a feature finds its parent in any group before or after it
+#only the IDs and coordinates of the parents are kept, until all their children are written
+def newGroupLinks(children):
+    return {"ids":{}, "mRNAs":{}, "children":children, "waiting":{}}
+
+#counts the features of a RATT embl that list each parent ('note=Parent:'), for the parents that are in the embl
+#the IDs are escaped as readEmbl gives them, and only the first ID and Parent note of a feature are used, as by linkGroup
+#called by processRattEmbl
+def emblParentIDs(fileName):
+    noteIDs = set()
+    children = collections.Counter()
+    with open(fileName) as emblFile:
+        for key, location, qualifiers in parseEmbl(emblFile):
+            notes = [emblQualifierToAttribute(name, value)[1] for name, value in qualifiers
+                if name == "note" and value is not None and value.startswith(("ID:", "Parent:"))]
+            noteIDs.update([x[3:] for x in notes if x.startswith("ID:")][:1])
+            for parent in [x[7:] for x in notes if x.startswith("Parent:")][:1]:
+                children.update(parent.replace("%2C", ",").split(","))
+    return dict((parent, count) for parent, count in children.iteritems() if parent in noteIDs)
+
+#counts the features of a gff that list each parent ('note=Parent:'), for the parents that are in the gff
+#only the features before the ##FASTA line are counted
+#called by processRattEmbl
+def gffParentIDs(fileName):
+    noteIDs = set()
+    children = collections.Counter()
+    for line in parseGff(fileName):
+        if isFeature(line):
+            noteID = line.getPrefixedAttribute("note", "ID:")
+            if noteID is not None:
+                noteIDs.add(noteID)
+            children.update(noteParents(line))
+        elif line.startswith("##FASTA"):
+            break
+    return dict((parent, count) for parent, count in children.iteritems() if parent in noteIDs)
+
+#returns the original parent IDs of a feature ('note=Parent:'), the commas between them are escaped in the note
+#called by gffParentIDs, missingParents and forgetParents
+def noteParents(line):
+    parent = line.getPrefixedAttribute("note", "Parent:")
+    if parent is None:
+        return []
+    return parent.replace("%2C", ",").split(",")
+
+#returns the original parent IDs of a feature that are in the contig but not linked yet
+#called by linkGroup and releaseWaiting
+def missingParents(line, links):
+    return [p for p in noteParents(line) if p in links["children"] and p not in links["ids"]]
+
+#records the new ID, and the coordinates of an mRNA, of the first feature written with the original ID of a parent
+#returns the original ID, so the features waiting for it can be released, or None if it is not a parent to link
+#called by linkGroup and releaseWaiting
+def registerFeature(line, links):
+    noteID = line.getPrefixedAttribute("note", "ID:")
+    if noteID is None or noteID not in links["children"] or noteID in links["ids"]:
+        return None
+    featureID = line.getAttribute("ID")
+    links["ids"][noteID] = featureID
+    if line.type == "mRNA":
+        links["mRNAs"][featureID] = (line.start, line.end)
+    return noteID
+
+#counts the written features as children of their parents, a parent whose children are all written is forgotten
+#called by linkGroup and flushWaiting
+def forgetParents(lines, links):
+    children = links["children"]
+    for line in lines:
+        for p in noteParents(line):
+            if p in children:
+                children[p] -= 1
+                if not children[p]:
+                    del children[p]
+                    links["mRNAs"].pop(links["ids"].pop(p, None), None)
+
+#adds the features that waited for the given original IDs to released, and the features that waited for those
+#a feature that still misses another parent waits for that one instead
+#called by linkGroup
+def releaseWaiting(noteIDs, links, released):
+    queue = collections.deque(noteIDs)
+    while queue:
+        for line in links["waiting"].pop(queue.popleft(), []):
+            missing = missingParents(line, links)
+            if missing:
+                links["waiting"].setdefault(missing[0], []).append(line)
+                continue
+            released.append(line)
+            noteID = registerFeature(line, links)
+            if noteID is not None:
+                queue.append(noteID)
+
+#links the features of a gene group to their parents and fixes their CDS coordinates
+#a feature whose parent is later in the contig (e.g. a gff that lists all genes before their mRNAs) is held back
+#until its parent is linked, and is then written after the group of its parent, in the order of the contig
+#features whose parent is not in the contig at all are written in place, without a Parent
+#returns the features to write: the features of the group that were not held back and the features it released
+#called by fixGeneGroups
+def linkGroup(group, links):
+    inGroup = {}
+    for line in group:
+        noteID = line.getPrefixedAttribute("note", "ID:")
+        if noteID is not None:
+            inGroup.setdefault(noteID, True) #False once the feature is held back
+    #a feature is held back when a parent is neither linked nor in the group, or is held back itself
+    missing = [missingParents(line, links) for line in group]
+    held = [False]*len(group)
+    changed = True
+    while changed:
+        changed = False
+        for x, line in enumerate(group):
+            if not held[x] and [p for p in missing[x] if not inGroup.get(p, False)]:
+                held[x] = True
+                changed = True
+                noteID = line.getPrefixedAttribute("note", "ID:")
+                if noteID is not None:
+                    inGroup[noteID] = False
+
+    ready = []
+    linked = []
+    for x, line in enumerate(group):
+        if not held[x]:
+            ready.append(line)
+            noteID = registerFeature(line, links)
+            if noteID is not None:
+                linked.append(noteID)
+    for x, line in enumerate(group):
+        if held[x]:
+            links["waiting"].setdefault(missingParents(line, links)[0], []).append(line)
+    releaseWaiting(linked, links, ready)
+    ready = fixCdsCoordinates(addAllParents(ready, None, links["ids"]), None, links["mRNAs"])
+    forgetParents(ready, links)
+    return ready
+
+#returns the features that are still held back at the end of a contig, in the order they were held back, linked
+#to the parents that were found; only features whose parents depend on each other are left this late
+#called by fixGeneGroups
+def flushWaiting(links):
+    left = []
+    for noteID in sorted(links["waiting"]):
+        left.extend(links["waiting"][noteID])
+    links["waiting"] = {}
+    left = fixCdsCoordinates(addAllParents(left, None, links["ids"]), None, links["mRNAs"])
+    forgetParents(left, links)
+    return left
+
+#fixes the parsed lines of a RATT result one gene group at a time and writes them to the open outFile
+#each group is fixed by fixGroup (unless it is None) and linked to the rest of the contig by linkGroup
+#header and sequence lines are written as they are read, without sequence everything from the ##FASTA line is left out
+#warns once when fixing a group makes the memory of the process grow past memoryLimit MB (0 for no limit)
+#called by processRattEmbl
+def fixGeneGroups(lines, fixGroup, outFile, links, memoryLimit=0, name="", sequence=True):
+    warned = not memoryLimit
+    before = currentMemory() if memoryLimit else 0 #memory before the group was read
+    for group in geneGroups(lines):
+        if type(group) is not list:
+            if group.startswith("##FASTA"):
+                writeToFile(flushWaiting(links), outFile)
+                if not sequence:
+                    return
+            outFile.write(group)
+            continue
+        if fixGroup is not None:
+            group = fixGroup(group)
+        group = linkGroup(group, links)
+        writeToFile(group, outFile)
+        if warned:
+            continue
+        after = currentMemory()
+        if after > memoryLimit and after > before: #only the group that made the memory grow past the limit is named
+            features = [x for x in group if isFeature(x)]
+            region = ""
+            if features:
+                region = " at "+features[0].seqid+":"+str(min(x.start for x in features))+"-"+str(max(x.end for x in features))
+            sys.stderr.write("<RATTwithGFF.py> WARNING: "+name+" grew from "+str(before)+" to "+str(after)+" MB of memory while fixing the gene group"+
+                region+" ("+str(len(features))+" features), more than the --memory-limit of "+str(memoryLimit)+" MB\n")
+            warned = True
+        before = after
+    writeToFile(flushWaiting(links), outFile) #a result without sequence
+
+#size of the memory pages counted in /proc/self/statm
+PAGE_SIZE = resource.getpagesize()
+
+#returns the current memory (resident set size) of this process in MB
+#without /proc (e.g. on macOS) the peak memory is returned instead, which only grows
+#called by fixGeneGroups
+def currentMemory():
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1])*PAGE_SIZE/(1024*1024)
+    except (IOError, OSError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024
+
+#splits a stream of parsed gff lines into gene groups, lists of features that can be fixed on their own
+#a feature without a parent ('note=Parent:' or a Parent attribute) that has an original ID ('note=ID:') starts a new
+#group, unless it overlaps the features of the group before it so that interleaved genes stay together
+#all other features join the group before it, features without either can not be linked and do not widen the group
+#header, comment and sequence lines end a group and are passed on as they are
+#called by fixGeneGroups
+def geneGroups(lines):
+    group = []
+    span = None #seqid, start and end of the linked features in the group
+    for line in lines:
+        if not isFeature(line):
+            if group:
+                yield group
+                group = []
+                span = None
+            yield line
+            continue
+        hasParent = line.getPrefixedAttribute("note", "Parent:") is not None or line.getAttribute("Parent") is not None
+        isRoot = not hasParent and line.getPrefixedAttribute("note", "ID:") is not None
+        overlaps = span is not None and span[0] == line.seqid and line.start <= span[2] and line.end >= span[1]
+        if isRoot and group and not overlaps:
+            yield group
+            group = []
+            span = None
+        group.append(line)
+        if hasParent or isRoot:
+            if span is None or span[0] != line.seqid:
+                span = [line.seqid, line.start, line.end]
+            else:
+                span[1] = min(span[1], line.start)
+                span[2] = max(span[2], line.end)
+    if group:
+        yield group
 
 #calls seqret function to convert embl to gff
-def emblToGff(fileName):
-    print "\n<RATTwithGFF.py> converting: "+fileName+" to gff..."
+#the gff is written to outFileName
+#called by processRattEmbl
+def emblToGff(fileName, outFileName):
     subprocess.call(["seqret", "-sequence", fileName, "-feature",\
     "-fformat", "embl", "-fopenfile", fileName, "-osformat", "gff",\
-    "-osname", "temp01", "-auto"])
-
-# [0]:chrom [1]:source [2]:feature [3]:start [4]:end [5]:score [6]:strand [7]:phase [8]:info
-#seperates gff into a list[lines] of lists[line values]
+    "-outseq", outFileName, "-auto"])
+
+#embl qualifiers that are not carried over to the gff
+DROPPED_QUALIFIERS = set(["locus_tag", "transl_table", "codon_start"])
+
+#embl qualifiers that are renamed to the matching gff attribute
+RENAMED_QUALIFIERS = {"standard_name":"Name", "db_xref":"Dbxref"}
+
+#characters that are reserved in gff attribute values and their escapes
+GFF_ESCAPES = [(";","%3B"), ("=","%3D"), ("&","%26"), (",","%2C"), ("\t","%09")]
+GFF_RESERVED = re.compile("[;=&,\t]")
+
+#embl feature keys that are written as one gff line per segment of a joined location
+#all other joined features are written as a single line spanning the whole location
+SEGMENTED_FEATURES = set(["CDS"])
+
+#finds the query contig a RATT result belongs to from its file name
+#RATT names its results <runID>.<contig>.final.embl
+#called by processRattEmbl
+def rattContigName(embl):
+    contig = embl[:embl.find(".final")]
+    prefix = ratt_dir[:ratt_dir.rfind("_RATT")]+"."
+    if contig.startswith(prefix):
+        return contig[len(prefix):]
+    return contig[contig.find(".")+1:]
+
+#reads a RATT embl file and converts it directly into fixed gff lines
+#IDs are numbered <contig>.<n> in feature order, the segments of a joined CDS share one ID
+#the 'source' feature is skipped and gap features are numbered but not written, as in the seqret conversion
+#the sequence is added after a ##FASTA line
+#the lines are generated one at a time as the embl is read, so the features and sequence are never all in memory
+#called by processRattEmbl
+def readEmbl(fileName, contig):
+    yield "##gff-version 3\n"
+    yield "##sequence-region "+contig+" 1 "+str(emblSequenceLength(fileName))+"\n"
+    count = 0
+    with open(fileName) as emblFile:
+        for key, location, qualifiers in parseEmbl(emblFile):
+            if key == "source":
+                continue
+            count += 1
+            if key == "gap":
+                continue
+            strand, segments = parseEmblLocation(location)
+            if not segments:
+                continue
+            attributes = [("ID", contig+"."+str(count))]
+            for name, value in qualifiers:
+                if name not in DROPPED_QUALIFIERS:
+                    attributes.append(emblQualifierToAttribute(name, value))
+            if key not in SEGMENTED_FEATURES:
+                segments = [(min([x[0] for x in segments]), max([x[1] for x in segments]))]
+            for start, end in sorted(segments):
+                yield GffFeature(contig, ".", key, start, end, ".", strand, ".", list(attributes))
+
+        yield "##FASTA\n"
+        yield ">"+contig+"\n"
+        for line in readEmblSequence(emblFile):
+            yield line
+
+#sequence length in the ID line ('... 12345 BP.') or the SQ line ('SQ   Sequence 12345 BP;') of an embl
+EMBL_LENGTH = re.compile(r"(\d+) BP[.;]")
+
+#returns the length of the sequence of an embl, so that it can be written before the features
+#the length is read from the ID line, or from the SQ line after the features, or counted if neither has it
+#called by readEmbl
+def emblSequenceLength(fileName):
+    with open(fileName) as emblFile:
+        for line in emblFile:
+            if line.startswith("ID") or line.startswith("SQ"):
+                match = EMBL_LENGTH.search(line)
+                if match:
+                    return int(match.group(1))
+                if line.startswith("SQ"):
+                    return sum(len(x)-1 for x in readEmblSequence(emblFile))
+    return 0
+
+#streams the features of an embl file as (key, location, [(qualifier, value)])
+#continuation lines are joined to the line above, the file is read up to and including the SQ line
+#called by readEmbl
+def parseEmbl(emblFile):
+    feature = None
+    for line in emblFile:
+        if line.startswith("FT"):
+            content = line[21:].rstrip("\r\n")
+            if line[5:21].strip():
+                if feature is not None:
+                    yield finishEmblFeature(feature)
+                feature = [line[5:21].strip(), content.strip(), []]
+            elif feature is None:
+                continue
+            elif content.startswith("/"):
+                feature[2].append(content)
+            elif feature[2]:
+                feature[2][-1] += content #wrapped qualifier
+            else:
+                feature[1] += content.strip() #wrapped location
+        elif line.startswith("SQ"):
+            break
+    if feature is not None:
+        yield finishEmblFeature(feature)
+
+#streams the sequence of an embl file as fasta lines of FASTA_LINE_WIDTH bases
+#the file must have been read up to the SQ line
+#called by readEmbl and emblSequenceLength
+def readEmblSequence(emblFile):
+    bases = ""
+    for line in emblFile:
+        if line.startswith("//"):
+            break
+        bases += line.translate(None, " \t\r\n0123456789")
+        while len(bases) >= FASTA_LINE_WIDTH:
+            yield bases[:FASTA_LINE_WIDTH]+"\n"
+            bases = bases[FASTA_LINE_WIDTH:]
+    if bases:
+        yield bases+"\n"
+
+#splits the raw qualifier lines of a feature into names and unquoted values
+#called by parseEmbl
+def finishEmblFeature(feature):
+    qualifiers = []
+    for qualifier in feature[2]:
+        name, equals, value = qualifier[1:].partition("=")
+        if not equals:
+            qualifiers.append((name, None))
+            continue
+        if len(value) > 1 and value[0] == '"' and value[-1] == '"':
+            value = value[1:-1]
+            if value.find('""') != -1:
+                value = value.replace('""','"')
+        qualifiers.append((name, value))
+    return feature[0], feature[1], qualifiers
+
+#converts an embl location into a strand and a list of (start, end) segments
+#handles join(), order(), complement() and partial markers, references to other entries are skipped
+#called by readEmbl
+def parseEmblLocation(location):
+    strand = "-" if location.find("complement(") != -1 else "+"
+    segments = []
+    for part in re.split("[(),]", location):
+        part = part.strip().replace("<","").replace(">","")
+        if part in ("", "join", "order", "complement") or part.find(":") != -1:
+            continue
+        if part.find("..") != -1:
+            start, end = part.split("..")[:2]
+        elif part.find("^") != -1:
+            start, end = part.split("^")[:2]
+        else:
+            start = end = part
+        if start.isdigit() and end.isdigit():
+            segments.append((int(start), int(end)))
+    return strand, segments
+
+#converts one embl qualifier into a gff attribute (name, value) pair
+#called by readEmbl
+def emblQualifierToAttribute(name, value):
+    name = RENAMED_QUALIFIERS.get(name, name)
+    if value is None:
+        value = "true"
+    if GFF_RESERVED.search(value):
+        for character, escape in GFF_ESCAPES:
+            value = value.replace(character, escape)
+    return (name, value)
+
+#a single gff feature line
+#start and end are ints, the attributes are parsed once into an ordered list of (name, value) pairs
+#attribute values are kept escaped exactly as they are written in the gff
+#the line is only converted back to text by toLine when it is written
+class GffFeature(object):
+    __slots__ = ("seqid", "source", "type", "start", "end", "score", "strand", "phase", "attributes")
+
+    def __init__(self, seqid, source, featureType, start, end, score, strand, phase, attributes):
+        self.seqid = seqid
+        self.source = source
+        self.type = featureType
+        self.start = start
+        self.end = end
+        self.score = score
+        self.strand = strand
+        self.phase = phase
+        self.attributes = attributes
+
+    #returns the value of the first attribute with the given name or None
+    def getAttribute(self, name):
+        for attribute in self.attributes:
+            if attribute[0] == name:
+                return attribute[1]
+        return None
+
+    #returns the first value of a repeated attribute that starts with the given prefix, without the prefix
+    #used for the 'note=ID:' and 'note=Parent:' notes that keep the original IDs
+    def getPrefixedAttribute(self, name, prefix):
+        for attribute in self.attributes:
+            if attribute[0] == name and attribute[1] is not None and attribute[1].startswith(prefix):
+                return attribute[1][len(prefix):]
+        return None
+
+    #removes every attribute with one of the given names
+    def removeAttributes(self, names):
+        self.attributes = [x for x in self.attributes if x[0] not in names]
+
+    #renames every attribute with the given name
+    def renameAttribute(self, name, newName):
+        self.attributes = [(newName, x[1]) if x[0] == name else x for x in self.attributes]
+
+    #formats the feature as a tab-delimited gff line
+    def toLine(self):
+        attributes = ";".join([x[0] if x[1] is None else x[0]+"="+x[1] for x in self.attributes])
+        return "\t".join((self.seqid, self.source, self.type, str(self.start), str(self.end),
+            self.score, self.strand, self.phase, attributes))+"\n"
+
+#converts a gff line into a GffFeature, returns None for header, comment and sequence lines
+def parseGffLine(line):
+    values = line.rstrip("\r\n").split("\t")
+    if len(values) != 9 or line.startswith("#"):
+        return None
+    try:
+        start = int(values[3])
+        end = int(values[4])
+    except ValueError:
+        return None
+    return GffFeature(values[0], values[1], values[2], start, end, values[5], values[6], values[7], parseAttributes(values[8]))
+
+#seperates gff into GffFeatures, generated one line at a time
+#header, comment and sequence lines are kept as they are so they can be written back out
 def parseGff(fileName):
-    allParsedLines = []
-    parsedLine = []
     with open(fileName) as file:
         for line in file:
-            parsedLine = line.split("\t")
-            allParsedLines.append(parsedLine) #adds each parsed line to a list
-    subprocess.call(["rm", fileName])
-    return allParsedLines
+            feature = parseGffLine(line)
+            yield line if feature is None else feature
+
+#checks if a parsed line is a feature rather than a header or sequence line
+def isFeature(line):
+    return type(line) is GffFeature
 
 #finds the ID attribute in the given line
 def getID(line):
@@ -360,48 +2539,31 @@ def getID(line):
     idString = idString[:idString.find(";")]
     return idString
 
-#finds and returns the Parent attribute in the given line
-def getParent(line):
-    parent = line[line.find("Parent=")+7:]
-    if (parent.find(";") != -1):
-        parent = parent[:parent.find(";")]
-    else:
-        parent = parent[:len(parent)-1]
-    return parent
-
-#takes a line and adds the given idString to the line as a parent attribute
-def addParent(idString, line):
-    front = line[:line.find(";")+1]
-    back = line[line.find(";")+1:]
-    newString = front+"Parent="+idString+";"+back
-    return newString
-
 #reformats 'biological_region' features to be consistent with the standard gff format
 #these 'biological regions' feature are a consequence of using EMBOSS seqret embl->gff conversion 
 def fixBiologicalRegions(lines):
     x = 0
     newLines = []
     while (x < len(lines)):
-        #I have to check length of lines to distinguish between header and actual feature lines
-        if((len(lines[x]) == 9) and (lines[x][2] == "biological_region") and 
-        (lines[x][8].find("featflags=type:CDS") != -1)):
+        #I have to check the type of lines to distinguish between header and actual feature lines
+        if (isFeature(lines[x]) and lines[x].type == "biological_region" and
+        (lines[x].getAttribute("featflags") or "").find("type:CDS") != -1):
             bio_reg = x
             x+=1 #skips biological_region
-            while (len(lines[x]) == 9 and lines[x][2] == "CDS"):
-                lines[x][8] = lines[bio_reg][8] #assigns biological_region attributes to CDS
+            while (x < len(lines) and isFeature(lines[x]) and lines[x].type == "CDS"):
+                lines[x].attributes = list(lines[bio_reg].attributes) #assigns biological_region attributes to CDS
                 newLines.append(lines[x])
                 x+=1
 
-        elif ((len(lines[x]) == 9) and (lines[x][2] == "biological_region") and 
-            (lines[x][8].find("featflags=type:mRNA") != -1)):
-            bio_reg = x
-            lines[x][2] = "mRNA"
+        elif (isFeature(lines[x]) and lines[x].type == "biological_region" and
+            (lines[x].getAttribute("featflags") or "").find("type:mRNA") != -1):
+            lines[x].type = "mRNA"
             newLines.append(lines[x])
             x+=1
-            while (len(lines[x]) == 9 and lines[x][2] == "mRNA" and lines[x][8].find("ID=") == -1):
+            while (x < len(lines) and isFeature(lines[x]) and lines[x].type == "mRNA" and lines[x].getAttribute("ID") is None):
                 x+=1 #doesnt add the split up mRNA features unless it is a seperate mRNA from biological feature
 
-        elif (len(lines[x]) == 9) and (lines[x][2] == "databank_entry"):
+        elif isFeature(lines[x]) and lines[x].type == "databank_entry":
             x+=1 #doesnt add 'databank_entry' feature
 
         else:
@@ -410,210 +2572,391 @@ def fixBiologicalRegions(lines):
     return newLines
 
 #generates new IDs to replace the old ones
-def renumberIDs(lines):
-    count = 1
-    for x in range(0,len(lines)):
-        if (len(lines[x]) == 9):
-            oldID = lines[x][8][:lines[x][8].find(";")] #assumes ID is first attribute
-            lines[x][8] = lines[x][8][lines[x][8].find(";"):] #removes ID attribute
-            newID = lines[x][0]+"."+str(count) #generates new ID based on feature order
-            lines[x][8] = "ID="+newID+lines[x][8]
-
-            if (x+1 < len(lines)-1 and len(lines[x+1]) == 9):
-                if(oldID != lines[x+1][8][:lines[x+1][8].find(";")]): #if the next feature ID is different
-                    count+=1
+#assumes ID is the first attribute, features next to each other that share an ID keep sharing the new one
+#numbering holds the last number and old ID so that the gene groups of a contig are numbered on from each other
+def renumberIDs(lines, numbering=None):
+    if numbering is None:
+        numbering = {"count":0, "previous":None}
+    for line in lines:
+        if isFeature(line):
+            attributes = line.attributes
+            oldID = attributes[0] if attributes else None
+            if (numbering["count"] == 0 or oldID != numbering["previous"]): #if the ID is different from the feature before
+                numbering["count"] += 1
+            numbering["previous"] = oldID
+            newID = line.seqid+"."+str(numbering["count"]) #generates new ID based on feature order
+            if attributes:
+                attributes[0] = ("ID", newID)
+            else:
+                attributes.append(("ID", newID))
     return lines
 
-#calculates the phase value for a given feature
-#must provide the phase of the previous feature
-def getPhase(lines,index,prevPhase):
-    if (lines[index][2] == "CDS"):
-        if (lines[index][6] == "+"):
-            size = int(lines[index-1][4]) - (int(lines[index-1][3])-1) - int(prevPhase)
-            remainder = size%3
-
-        else:
-            size = int(lines[index+1][4]) - (int(lines[index+1][3])-1) - int(prevPhase)
-            remainder = size%3
-
-        if (remainder == 0):
-            return str(0)
-        
-        else:
-            return str(3-remainder)
-    
-    else:
-        return "."
+# [0]:first feature for each original ID (from 'note=ID:') [1]:first feature for each current ID
+# [2]:CDS features grouped by ID, the segments of each CDS in file order
+#indexes the features of a contig once so that parents can be found without rescanning every line
+#the index stays valid as long as the IDs are not changed and no features are added or removed
+def indexFeatures(lines):
+    byOriginalID = {}
+    byID = {}
+    cdsGroups = []
+    cdsByID = {}
+    for line in lines:
+        if isFeature(line):
+            featureID = line.getAttribute("ID")
+            byID.setdefault(featureID, line)
+            noteID = line.getPrefixedAttribute("note", "ID:")
+            if noteID is not None:
+                byOriginalID.setdefault(noteID, line)
+            if line.type == "CDS":
+                group = cdsByID.get(featureID)
+                if group is None: #a CDS without an ID is a group on its own
+                    group = []
+                    cdsGroups.append(group)
+                    if featureID is not None:
+                        cdsByID[featureID] = group
+                group.append(line)
+    return byOriginalID, byID, cdsGroups
 
 #using information stored from the original gff
 #finds if the parent feature was transferred
 #adds the approprate parent attribute to link the features
-def addAllParents(lines):
+#a feature with several parents (note=Parent:a,b) is linked to each of them that was transferred
+#ids maps the original IDs to the new ones, by default they are taken from the lines themselves
+def addAllParents(lines, index=None, ids=None):
+    if ids is None:
+        if index is None:
+            index = indexFeatures(lines)
+        ids = dict((noteID, line.getAttribute("ID")) for noteID, line in index[0].iteritems())
     for x in lines:
-        if (len(x) == 9):
-            if (x[8].find("note=Parent:") != -1):
-                parent = x[8][x[8].find("note=Parent:")+12:]
-                if (parent.find(";") != -1):
-                    parent = parent[:parent.find(";")]
-                
-                else:#parent is last feature
-                    parent = parent[:len(parent)-1]
-                
-                #finds parent feature
-                for y in lines:
-                    if (len(y) == 9):
-                        if(y[8].find("note=ID:") != -1 ):
-                            noteID = y[8][y[8].find("note=ID:")+8:]
-                            noteID = noteID[:noteID.find(";")]
-                            if (noteID == parent):
-                                parent = getID(y[8])
-                                x[8] = addParent(parent,x[8]) #adds corrected parent ID
-                                break
+        if isFeature(x):
+            parent = x.getPrefixedAttribute("note", "Parent:")
+            if parent is None:
+                continue
+            #finds parent features, the commas between them are escaped in the note
+            parents = [ids[p] for p in parent.replace("%2C", ",").split(",") if p in ids]
+            if parents:
+                #adds corrected parent ID after the ID
+                x.attributes.insert(1, ("Parent", ",".join(parents)))
     return lines
 
-                
-
-#For all CDS features, the phase is calculated and set
-def fixCdsPhase(lines):
-    x=0
-    while(x < len(lines)):
-        if ( len(lines[x]) == 9 and lines[x][2] == "CDS"):
-            if lines[x][6] == "+":
-                phase = str(0)
-                lines[x][7] = phase
-                x+=1
-                while (len(lines[x]) == 9 and lines[x][2] == "CDS"):
-                    phase = getPhase(lines,x,phase)
-                    lines[x][7] = phase
-                    x+=1
-            else: #CDS phase on opposite strand must be calculated bottom->top
-                negCDS = []
-                while (len(lines[x]) == 9 and lines[x][2] == "CDS"):
-                    negCDS.append(x)
-                    x+=1
-                i=negCDS[len(negCDS)-1]
-                phase = str(0)
-                lines[i][7] = phase
-                i-=1
-                while (i >= negCDS[0]):
-                    phase = getPhase(lines,i,phase)
-                    lines[i][7] = phase
-                    i-=1
+#phase column values indexed by phase, so the phases are only turned into text once
+PHASES = ("0", "1", "2")
+
+# [features]:the CDS segments of a contig grouped by transcript, transcript t is features[offsets[t]:offsets[t+1]]
+# [starts] [ends] [phases]:typed arrays with the coordinates and phase of each segment
+# [strands]:1 or -1 for each transcript [parents]:the Parent ID of each transcript
+#the features themselves are only changed again by writeCdsModel
+def buildCdsModel(cdsGroups):
+    features = []
+    offsets = array.array("l", [0])
+    strands = array.array("b")
+    parents = []
+    for group in cdsGroups:
+        features.extend(group)
+        offsets.append(len(features))
+        strands.append(1 if group[0].strand == "+" else -1)
+        parents.append(group[0].getAttribute("Parent"))
+    return {"features":features, "offsets":offsets, "strands":strands, "parents":parents,
+        "starts":array.array("l", [x.start for x in features]), "ends":array.array("l", [x.end for x in features]),
+        "phases":array.array("b", [0])*len(features)}
+
+#sets the phase of every CDS segment to the length of the segments before it in its transcript, mod 3
+#CDS phase on opposite strand must be calculated bottom->top
+def fixCdsPhase(model):
+    starts, ends, phases = model["starts"], model["ends"], model["phases"]
+    offsets, strands = model["offsets"], model["strands"]
+    for t in xrange(len(strands)):
+        if strands[t] == 1:
+            segments = xrange(offsets[t], offsets[t+1])
         else:
-            x+=1
-    return lines            
-
-#removes a given attribute from a given line
-def removeAttribute(line, attribute):
-    if (line.find(attribute) != -1):
-        startPos = line.find(attribute)
-        substr = line[startPos:]
-        if (substr.find(";") != -1):
-            endPos = substr.find(";")+startPos+1
-
-        else:
-            endPos = len(substr)+startPos
-
-        newLine = line[:startPos] + line[endPos:] #makes new line excluding the given attribute
-        if (newLine.find("\n") == -1):
-            if(newLine[len(newLine)-1] == ";"):
-                newLine = newLine[:len(newLine)-1] #removes tailing ";"
-            newLine = newLine+"\n" #adds missing endline
+            segments = xrange(offsets[t+1]-1, offsets[t]-1, -1)
+        length = 0
+        for x in segments:
+            phases[x] = -length % 3
+            length += ends[x] - starts[x] + 1
 
-        if newLine.find(attribute) != -1:
-            newLine = removeAttribute(newLine, attribute) #runs recursively until all of the given attribute are removed
-            return newLine
-        else:
-            return newLine
-    
-    else:
-        return line
+#makes sure all CDS start and end positions are within mRNA start and end positions
+#mRNAs holds the start and end of each mRNA by ID, each transcript looks up its parent once
+def fixCdsPos(model, mRNAs):
+    starts, ends, offsets = model["starts"], model["ends"], model["offsets"]
+    for t in xrange(len(model["parents"])):
+        y = mRNAs.get(model["parents"][t])
+        if (y is not None): #finds the mRNA parent
+            for x in xrange(offsets[t], offsets[t+1]):
+                if (starts[x] < y[0]):
+                    starts[x] = y[0]
+                if (ends[x] > y[1]):
+                    ends[x] = y[1]
+
+#copies the coordinates and phases of the model back to the CDS features
+def writeCdsModel(model):
+    starts, ends, phases = model["starts"], model["ends"], model["phases"]
+    for x, feature in enumerate(model["features"]):
+        feature.start = starts[x]
+        feature.end = ends[x]
+        feature.phase = PHASES[phases[x]]
+
+#fixes the phase of all CDS features and keeps them within their mRNA
+#the phases are calculated from the CDS lengths before they are clamped to the mRNA
+#mRNAs holds the start and end of each mRNA by ID, by default they are taken from the lines themselves
+def fixCdsCoordinates(lines, index=None, mRNAs=None):
+    if index is None:
+        index = indexFeatures(lines)
+    if mRNAs is None:
+        mRNAs = dict((featureID, (line.start, line.end)) for featureID, line in index[1].iteritems() if line.type == "mRNA")
+    model = buildCdsModel(index[2])
+    fixCdsPhase(model)
+    fixCdsPos(model, mRNAs)
+    writeCdsModel(model)
+    return lines
 
+#attributes added by the embl conversion that are not needed in the final gff
+REMOVED_ATTRIBUTES = set(["locus_tag", "transl_table", "codon_start", "featflags"])
 
 #removes all attributes that are not needed
 def cleanAttributes(lines):
     for line in lines:
-        if (len(line) == 9):
-            line[8] = removeAttribute(line[8],"locus_tag")
-            # line[8] = removeAttribute(line[8],"note=")
-            line[8] = removeAttribute(line[8],"transl_table")
-            line[8] = removeAttribute(line[8],"codon_start")
-            line[8] = removeAttribute(line[8],"featflags")
-            line[8] = line[8].replace("standard_name=","Name=")
-            if (line[2] == "ncRNA"):
-                line[8] = line[8].replace("ncrna_class=","ncRNA_class=")        
-    return lines
-
-#makes sure all CDS start and end positions are within mRNA start and end positions
-def fixCdsPos(lines):
-    for x in lines:
-        if (len(x) == 9 and x[2] == "CDS"):
-            parent = getParent(x[8])
-            for y in lines:
-                if (len(y) == 9 and y[2] == "mRNA" and getID(y[8]) == parent): #finds the mRNA parent
-                    if (x[3] < y[3]): #makes sure the CDS start and end are within the mRNA start and end
-                        x[3] = y[3]
-                    if (x[4] > y[4]):
-                        x[4] = y[4]
-                    break
+        if isFeature(line):
+            line.removeAttributes(REMOVED_ATTRIBUTES)
+            line.renameAttribute("standard_name","Name")
+            if (line.type == "ncRNA"):
+                line.renameAttribute("ncrna_class","ncRNA_class")
     return lines
 
-
-
-
 #removes the source column info
 #cleans the chromosome column to only include the contig id
 def cleanChromAndSource(lines):
     for line in lines:
-        if (len(line) == 9):
-            line[0] = line[0][:line[0].find(".final")]
-            line[0] = line[0][line[0].find(".")+1:]
-            line[1] = "."
+        if isFeature(line):
+            line.seqid = line.seqid[:line.seqid.find(".final")]
+            line.seqid = line.seqid[line.seqid.find(".")+1:]
+            line.source = "."
     return lines
 
-#outputs reformatted lines to file
-def writeToFile(lines,outFileName):
-    with open(outFileName, "w") as outFile:
-        for line in range(0,len(lines)):
-            newLine = "\t".join(lines[line])
-            if (newLine.find("\tgap\t") ==-1): #removes gap features, it doesn't make sense to transfer gap annotations between assemblies
-                outFile.write(newLine)
-
-#adds the annotations from a contig gff to the genomic gff
-def addToGenomicGff(inputGff,genomicGff):
-    print "\nadding: "+inputGff+" annotations to: "+genomicGff
-    with open(inputGff, 'r') as inFile:
-        with open(genomicGff, 'a') as outFile:
-            for line in inFile:
-                if line.find("##FASTA") != -1:
-                    break
+#writes the fixed lines to the open outFile as gff text
+def writeToFile(lines, outFile):
+    text = []
+    for line in lines:
+        if not isFeature(line):
+            text.append(line)
+        elif (line.type != "gap"): #removes gap features, it doesn't make sense to transfer gap annotations between assemblies
+            text.append(line.toLine())
+    outFile.write("".join(text))
+
+#adds the annotations from the lines of a contig gff to the open genomic gff
+#the features counted in the transfer stats are added to transferred as type -> {ID: original ID}
+#the features are also added to sortedLines by contig when a sorted copy of the genomic gff is made
+#and to records as GffFeatures when the features are returned by runTransfer
+def addToGenomicGff(lines, genomic, transferred=None, sortedLines=None, records=None):
+    for line in lines:
+        if line.find("##FASTA") != -1:
+            break
+        else:
+            if (line.find("#") == -1):
+                genomic.write(line)
+                feature = tallyFeature(line) if transferred is not None else None
+                if feature is not None:
+                    transferred.setdefault(feature[0], {})[feature[1]] = getOriginalID(line)
+                if sortedLines is not None and line.count("\t") >= 4:
+                    contigLines = sortedLines.setdefault(line[:line.find("\t")], [])
+                    contigLines.append((int(line.split("\t", 4)[3]), len(contigLines), line))
+                if records is not None:
+                    feature = parseGffLine(line)
+                    if feature is not None:
+                        records.append(feature)
+
+#an output for fixGeneGroups that adds the features of a contig to the open genomic gff as they are written
+#everything is also written to the open contigGff unless it is None
+#used by processRattResults with one job, so that a contig is not read back from a file
+class GenomicGffStream(object):
+    def __init__(self, genomic, transferred=None, sortedLines=None, records=None):
+        self.genomic = genomic
+        self.transferred = transferred
+        self.sortedLines = sortedLines
+        self.records = records
+        self.contigGff = None
+        self.sequence = False #True after the ##FASTA line, which ends the features
+
+    def write(self, text):
+        if self.contigGff is not None:
+            self.contigGff.write(text)
+        if not self.sequence:
+            end = text.find("##FASTA")
+            self.sequence = end != -1
+            addToGenomicGff(text[:end if self.sequence else len(text)].splitlines(True), self.genomic, self.transferred,
+                self.sortedLines, self.records) #the sequence can be written in one piece with the ##FASTA line
+
+#returns the reference ID kept as a note by writeEmbl, or None if the line does not have one
+#called by addToGenomicGff
+def getOriginalID(line):
+    start = line.find("note=ID:")
+    if start == -1:
+        return None
+    end = line.find(";", start)
+    return line[start+8:end if end != -1 else len(line.rstrip("\n"))]
+
+#uncompressed size of the blocks of a bgzip file, as used by htslib
+BGZF_BLOCK_SIZE = 0xff00
+
+#empty block that marks the end of a bgzip file
+BGZF_EOF = "\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00"
+
+#writes a bgzip file, a series of gzip blocks that each hold at most BGZF_BLOCK_SIZE bytes
+#tell returns the virtual offset (block address << 16 | offset in block) used by tabix indexes
+class BgzfWriter(object):
+    def __init__(self, fileName):
+        self.file = open(fileName, "wb")
+        self.address = 0 #file offset of the block in the buffer
+        self.buffer = []
+        self.size = 0
+
+    def write(self, data):
+        while self.size+len(data) >= BGZF_BLOCK_SIZE:
+            cut = BGZF_BLOCK_SIZE-self.size
+            self.buffer.append(data[:cut])
+            self.size = BGZF_BLOCK_SIZE
+            self.flush()
+            data = data[cut:]
+        if data:
+            self.buffer.append(data)
+            self.size += len(data)
+
+    def tell(self):
+        return self.address << 16 | self.size
+
+    def flush(self):
+        if not self.size:
+            return
+        data = "".join(self.buffer)
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15) #raw deflate, the header is written here
+        deflated = compressor.compress(data)+compressor.flush()
+        block = struct.pack("<BBBBIBBHBBHH", 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, len(deflated)+25)
+        block += deflated+struct.pack("<II", zlib.crc32(data) & 0xffffffff, len(data))
+        self.file.write(block)
+        self.address += len(block)
+        self.buffer = []
+        self.size = 0
+
+    def close(self):
+        self.flush()
+        self.file.write(BGZF_EOF)
+        self.file.close()
+
+#writes the features of the genomic gff sorted by position within each contig to a bgzip file
+#contigs are kept in the order they first appear in the genomic gff
+#a tabix index (fileName.tbi) is written as well so that regions can be read without scanning the file
+#called by processRattResults
+def writeBgzipGff(sortedLines, fileName):
+    bgzf = BgzfWriter(fileName)
+    bgzf.write("##gff-version 3\n")
+    records = collections.OrderedDict() #contig -> [(start, end, virtual start, virtual end)]
+    try:
+        for contig, lines in sortedLines.iteritems():
+            contigRecords = records[contig] = []
+            for start, x, line in sorted(lines):
+                virtualStart = bgzf.tell()
+                bgzf.write(line)
+                contigRecords.append((start-1, int(line.split("\t", 5)[4]), virtualStart, bgzf.tell()))
+    finally:
+        bgzf.close()
+    writeTabixIndex(records, fileName+".tbi")
+
+#returns the bin of the tabix binning scheme that holds the 0-based, end exclusive region
+#called by writeTabixIndex
+def regionToBin(start, end):
+    end -= 1
+    for shift, offset in ((14, 4681), (17, 585), (20, 73), (23, 9), (26, 1)):
+        if start >> shift == end >> shift:
+            return offset+(start >> shift)
+    return 0
+
+#writes a tabix index for a bgzip gff, records holds the (start, end, virtual start, virtual end) of each feature by contig
+#start is 0-based and end exclusive, the features of each contig must be sorted by start
+#called by writeBgzipGff
+def writeTabixIndex(records, fileName):
+    names = "".join(contig+"\0" for contig in records)
+    index = BgzfWriter(fileName)
+    try:
+        #gff preset of tabix: generic format, contig, start and end in columns 1, 4 and 5, '#' for comments
+        index.write("TBI\1"+struct.pack("<8i", len(records), 0, 1, 4, 5, ord("#"), 0, len(names))+names)
+        for contigRecords in records.values():
+            bins = collections.OrderedDict() #bin -> [[virtual start, virtual end]]
+            linear = [] #smallest virtual start of the features in each 16kb window
+            for start, end, virtualStart, virtualEnd in contigRecords:
+                chunks = bins.setdefault(regionToBin(start, max(end, start+1)), [])
+                if chunks and chunks[-1][1] == virtualStart:
+                    chunks[-1][1] = virtualEnd
                 else:
-                    if (line.find("#") == -1):
-                        outFile.write(line)
-
-#counts the amount of unique features in each category
-#generates a table that compares the original feature counts to the counts in the final output
-def makeTransferStats(originalGFF, newGFF):
-    nameArray = ["CDS","exon","gene","mRNA","tRNA","ncRNA","rRNA","total features"]
-    origCounts = countUniqueOccurences(originalGFF,nameArray)
-    finalCounts = countUniqueOccurences(newGFF,nameArray)
-    writeStatsToFile(origCounts,finalCounts, nameArray)
-
-#generates a list of sets that contain unique IDs categorized by feature
-def countUniqueOccurences(gff, names):
-    sortedUniqueIDs = [set() for x in range(0,len(names))] #generates a list of sets
-    with open(gff) as file:                                 #list index lines up with name array
-        for line in file:
-            values = line.split("\t")
-            for i in range(0,len(names)-1):
-                if (len(values) == 9 and values[2] == names[i]):
-                    sortedUniqueIDs[i].add(getID(values[8])) #adds ID to set that corresponds to the feature
-    total = 0
-    for IDs in sortedUniqueIDs:
-        total+=len(IDs) #counts up the total unique features
-    for x in range(0,total):
-        sortedUniqueIDs[len(sortedUniqueIDs)-1].add(x) #generates a set with unqiue values that equal the total
-    return sortedUniqueIDs
+                    chunks.append([virtualStart, virtualEnd])
+                for window in xrange(start >> 14, ((max(end, start+1)-1) >> 14)+1):
+                    if window >= len(linear):
+                        linear.extend([None]*(window+1-len(linear)))
+                    if linear[window] is None:
+                        linear[window] = virtualStart
+            for window in xrange(len(linear)):
+                if linear[window] is None:
+                    linear[window] = linear[window-1] if window else 0
+            index.write(struct.pack("<i", len(bins)))
+            for binNumber, chunks in bins.iteritems():
+                index.write(struct.pack("<Ii", binNumber, len(chunks)))
+                for chunk in chunks:
+                    index.write(struct.pack("<QQ", chunk[0], chunk[1]))
+            index.write(struct.pack("<i", len(linear))+struct.pack("<"+str(len(linear))+"Q", *linear))
+        index.write(struct.pack("<Q", 0)) #features without coordinates
+    finally:
+        index.close()
+
+# [original] [final] [transferred]:Counters by type (and TOTAL_ROW) of the reference features, the final features
+#and the reference features that were transferred [byContig]:reference contig -> [original, transferred]
+# [notTransferred]:(contig, type, ID) of each reference feature that was not transferred
+# [reference] [query]:the assembly statistics from assemblyStats
+#counts the unique features of each type in the reference and in the final output
+#the reference features come from the split, the final ones were collected while writing genomic.final.gff
+#a reference feature is transferred when a final feature of the same type carries its ID as a note
+#writes transferStats.csv, the transfer rates by type and by reference contig and the features that did not transfer
+#returns the same numbers as a dict
+#called by transferToQuery
+def makeTransferStats(features, transferred, refStats, queryStats):
+    origCounts = collections.Counter()
+    movedCounts = collections.Counter()
+    contigs = collections.OrderedDict() #reference contig -> [original, transferred]
+    failed = []
+    moved = dict((featureType, set(IDs.values())) for featureType, IDs in transferred.iteritems())
+    for contig, featureType, featureID in features:
+        counts = contigs.setdefault(contig, [0, 0])
+        origCounts[featureType] += 1
+        counts[0] += 1
+        if featureID in moved.get(featureType, ()):
+            movedCounts[featureType] += 1
+            counts[1] += 1
+        else:
+            failed.append((contig, featureType, featureID))
+    finalCounts = collections.Counter(dict((featureType, len(IDs)) for featureType, IDs in transferred.iteritems()))
+    for counts in (origCounts, finalCounts, movedCounts):
+        counts[TOTAL_ROW] = sum(counts[featureType] for featureType in STAT_FEATURES)
+
+    writeStatsToFile(origCounts, finalCounts, STAT_FEATURES+[TOTAL_ROW], refStats, queryStats)
+    with open(ratt_dir+"/transferStatsByType.csv","w") as file:
+        file.write("Feat.,Orig.,Transferred,Rate\n")
+        for name in STAT_FEATURES+[TOTAL_ROW]:
+            file.write(name+","+str(origCounts[name])+","+str(movedCounts[name])+","+transferRate(movedCounts[name], origCounts[name])+"\n")
+    with open(ratt_dir+"/transferStatsByContig.csv","w") as file:
+        file.write("Contig,Orig.,Transferred,Rate\n")
+        for contig, counts in contigs.iteritems():
+            file.write(contig+","+str(counts[0])+","+str(counts[1])+","+transferRate(counts[1], counts[0])+"\n")
+    with open(ratt_dir+"/notTransferred.tsv","w") as file:
+        file.write("Contig\tFeat.\tID\n")
+        for feature in failed:
+            file.write("\t".join(feature)+"\n")
+    return {"original":origCounts, "final":finalCounts, "transferred":movedCounts, "byContig":contigs,
+        "notTransferred":failed, "reference":refStats, "query":queryStats}
+
+#formats the percentage of the original features that were transferred, empty when there were none
+#called by makeTransferStats
+def transferRate(moved, original):
+    if not original:
+        return ""
+    return format(100.0*moved/original, '.2f')
 
 #converts tab-delimited quast report into a 2d list
 def parseQuast(results):
@@ -629,33 +2972,105 @@ def parseQuast(results):
             table.append(row)
     return table
     
-#writes out the unique feature count data as a comma-delimited file
-def writeStatsToFile(oCounts,fCounts, names):
-    # refQuastResults = parseQuast(ratt_dir+"/ref_quast/report.tsv")
-    # queryQuastResults = parseQuast(ratt_dir+"/query_quast/report.tsv")
+#runs of at least this many Ns split a scaffold into contigs, as in QUAST
+CONTIG_GAP_SIZE = 10
+
+#splits a sequence line into alternating runs of bases and runs of Ns
+N_RUNS = re.compile("([Nn]+)")
+
+#computes the assembly statistics of a fasta in a single pass over the file
+#scaffolds are the fasta sequences, contigs are the pieces left after splitting them at CONTIG_GAP_SIZE or more Ns
+#N50 and L50 are computed from the scaffold lengths, unlike QUAST short sequences are counted as well
+#returns a list of (statistic, value) in the order they are written to transferStats.csv
+#called by runTransfer and transferToQuery
+def assemblyStats(fasta):
+    lengths = []
+    contigs = 0
+    nCount = 0
+    length = None
+    with open(fasta) as file:
+        for line in file:
+            if line.startswith(">"):
+                if length is not None:
+                    lengths.append(length)
+                length = 0
+                gap = 0
+                inContig = False
+                continue
+            line = line.rstrip("\n")
+            length += len(line)
+            if "N" in line or "n" in line:
+                pieces = N_RUNS.split(line)
+            else:
+                pieces = [line]
+            for i in xrange(len(pieces)):
+                if not pieces[i]:
+                    continue
+                if i % 2:
+                    gap += len(pieces[i])
+                    nCount += len(pieces[i])
+                else:
+                    if not inContig or gap >= CONTIG_GAP_SIZE:
+                        contigs += 1 #the first bases of a scaffold or the bases after a gap start a contig
+                    inContig = True
+                    gap = 0
+    if length is not None:
+        lengths.append(length)
+
+    total = sum(lengths)
+    n50 = 0
+    l50 = 0
+    covered = 0
+    for length in sorted(lengths, reverse=True):
+        if 2*covered >= total:
+            break
+        covered += length
+        n50 = length
+        l50 += 1
+    nsPer100kbp = 0.0
+    if total:
+        nsPer100kbp = nCount*100000.0/total
+    return [("Assembly Length", str(total)), ("Scaffolds", str(len(lengths))), ("Contigs", str(contigs)),
+        ("Ns per 100kbp", format(nsPer100kbp, '.2f')), ("N50", str(n50)), ("L50", str(l50))]
+
+#writes out the unique feature count data and the assembly statistics as a comma-delimited file
+def writeStatsToFile(oCounts,fCounts, names, refStats, queryStats):
     with open(ratt_dir+"/transferStats.csv","w") as file:
         file.write("Feat.,Orig.,Final\n")
         for x in range(0,len(names)):
             file.write(names[x])
             file.write(",")
-            file.write(str(len(oCounts[x])))
+            file.write(str(oCounts[names[x]]))
             file.write(",")
-            file.write(str(len(fCounts[x])))
+            file.write(str(fCounts[names[x]]))
             file.write("\n")
-        
-        # file.write("Assembly Length,"+refQuastResults[15][1]+","+queryQuastResults[15][1]+"\n")
-
-        # #if the given genomes have contigs within scaffolds
-        # if len(refQuastResults[0]) == 3 and len(queryQuastResults[0]) == 3:    
-        #     file.write("Scaffolds,"+refQuastResults[13][1]+","+queryQuastResults[13][1]+"\n")
-        #     file.write("Contigs,"+refQuastResults[13][2]+","+queryQuastResults[13][2]+"\n")
-        #     file.write("Ns per 100kbp,"+refQuastResults[20][2]+","+queryQuastResults[20][2]+"\n")
-        # else:
-        #     file.write("Contigs,"+refQuastResults[13][1]+","+queryQuastResults[13][1]+"\n")
-        #     file.write("Ns per 100kbp,"+refQuastResults[20][1]+","+queryQuastResults[20][1]+"\n")
 
-        # file.write("N50,"+refQuastResults[16][1]+","+queryQuastResults[16][1]+"\n")
-        # file.write("L50,"+refQuastResults[18][1]+","+queryQuastResults[18][1]+"\n")
+        for x in range(0,len(refStats)):
+            file.write(refStats[x][0]+","+refStats[x][1]+","+queryStats[x][1]+"\n")
+
+#combines the transferStats.csv of each query into a single table in ratt_dir
+#the reference column is taken from the first query, followed by a column for each query
+#called by runTransfer
+def writeBatchStats(runIDs):
+    names = []
+    origCounts = {}
+    finalCounts = collections.defaultdict(dict)
+    for runID in runIDs:
+        with open(runID+"_RATT/transferStats.csv") as stats:
+            stats.readline() #header
+            for line in stats:
+                vals = line.rstrip("\n").split(",")
+                if vals[0] not in origCounts:
+                    names.append(vals[0])
+                    origCounts[vals[0]] = vals[1]
+                finalCounts[vals[0]][runID] = vals[2]
+    with open(ratt_dir+"/transferStats.csv","w") as file:
+        file.write("Feat.,Orig.,"+",".join(runIDs)+"\n")
+        for name in names:
+            file.write(name+","+origCounts[name])
+            for runID in runIDs:
+                file.write(","+finalCounts[name].get(runID, ""))
+            file.write("\n")
 
 #outputs the transfer stats to stdout            
 def printTransferStats():
@@ -664,10 +3079,8 @@ def printTransferStats():
     with open(statsFile) as stats:
         for line in stats:
             vals = line.split(",")
-            spaces1 = (20-len(vals[0]))*' '
-            spaces2 = (20-len(vals[1]))*' '
-            output = vals[0]+spaces1+vals[1]+spaces2+vals[2]
+            output = "".join(val.ljust(20) for val in vals[:-1])+vals[-1] #batch stats have a column for each query
             sys.stdout.write(output)
 
-main()
-
+if __name__ == "__main__":
+    main()
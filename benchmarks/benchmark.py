@@ -0,0 +1,494 @@
+#!/usr/bin/env python2.7
+
+##############################################################################################################
+# benchmark.py                                                                                               #
+# Function: Times the pure-Python passes of RATTwithGFF.py on synthetic genomes. No external tools are       #
+#   needed: the seqret-style gffs, the wrapped embl files and the genomic gffs the passes work on are         #
+#   generated with a given number of contigs, genes per contig and exons per gene. The results can be saved  #
+#   as json and two saved results (e.g. from two revisions) can be compared. With --ratt-shards RATT itself is #
+#   timed on the example data with each number of shards, which needs RATT and the other tools installed.    #
+##############################################################################################################
+
+import argparse
+import bisect
+import gc
+import hashlib
+import itertools
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import timeit
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+import RATTwithGFF
+
+#passes that work on the features of a RATT result, in the order fixSeqretGroup and linkGroup run them on seqret output
+#each pass is timed on the output of the passes before it
+RESULT_PASSES = ["fixBiologicalRegions", "cleanChromAndSource", "renumberIDs", "cleanAttributes",
+    "indexFeatures", "addAllParents", "fixCdsCoordinates"]
+
+#passes that work on files
+FILE_PASSES = ["fixBrokenLines", "addToGenomicGff"]
+
+PASSES = FILE_PASSES[:1] + RESULT_PASSES + FILE_PASSES[1:]
+
+#the example chromosome, cut into pieces for --ratt-shards and transferred to itself
+EXAMPLE_GFF = os.path.join(REPO_DIR, "example", "CM000429.1.gff")
+EXAMPLE_FASTA = os.path.join(REPO_DIR, "example", "CM000429.1.fa")
+
+#a qualifier long enough to be wrapped by EMBLmyGFF3
+LONG_PRODUCT = "hypothetical protein conserved in the synthetic benchmark genome with a deliberately long product name"
+
+def main():
+    args = parseArgs(sys.argv[1:])
+    if args.compare:
+        compareResults(args.compare[0], args.compare[1], args.threshold)
+        return
+    if args.rattShards:
+        workDir = tempfile.mkdtemp(prefix="rattbench_")
+        try:
+            results = benchmarkShards(args.rattShards, args.pieces, args.rattType, args.repeat, workDir)
+        finally:
+            shutil.rmtree(workDir)
+        printShardResults(results)
+        return
+
+    workDir = tempfile.mkdtemp(prefix="rattbench_")
+    try:
+        results = []
+        for contigs, genes, exons in itertools.product(args.contigs, args.genes, args.exons):
+            genome = makeGenome(contigs, genes, exons, args.seed)
+            results.extend(benchmarkGenome(genome, contigs, genes, exons, args.passes, args.repeat, workDir))
+    finally:
+        shutil.rmtree(workDir)
+
+    printResults(results)
+    printScaling(results)
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump({"revision":getRevision(), "python":platform.python_version(), "repeat":args.repeat,
+                "seed":args.seed, "results":results}, output, indent=1, sort_keys=True)
+        print "\nresults written to "+args.output
+
+#parses the command line arguments
+#called by main
+def parseArgs(argv):
+    parser = argparse.ArgumentParser(prog="benchmark.py",
+        description="Times the pure-Python passes of RATTwithGFF.py on synthetic genomes")
+    parser.add_argument("--contigs", type=parseSizes, default=[2],
+        help="comma-separated numbers of contigs (default: 2)")
+    parser.add_argument("--genes", type=parseSizes, default=[100, 200, 400, 800],
+        help="comma-separated numbers of genes per contig (default: 100,200,400,800)")
+    parser.add_argument("--exons", type=parseSizes, default=[4],
+        help="comma-separated numbers of exons per gene (default: 4)")
+    parser.add_argument("--passes", type=lambda value: value.split(","), default=PASSES,
+        help="comma-separated passes to time (default: all of "+",".join(PASSES)+")")
+    parser.add_argument("--repeat", type=int, default=3,
+        help="times each pass is run, the fastest run is reported (default: 3)")
+    parser.add_argument("--ratt-shards", dest="rattShards", type=parseSizes,
+        help="comma-separated numbers of RATT shards to time on the example data instead of the passes, e.g. 1,2,4")
+    parser.add_argument("--pieces", type=int, default=8,
+        help="number of reference contigs the example chromosome is cut into for --ratt-shards (default: 8)")
+    parser.add_argument("--ratt-type", dest="rattType", default="Assembly",
+        help="RATT transfer type used by --ratt-shards (default: Assembly)")
+    parser.add_argument("--seed", type=int, default=1, help="seed of the synthetic genomes (default: 1)")
+    parser.add_argument("-o", "--output", help="write the results to a json file")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"),
+        help="compare two json files written with --output instead of running the benchmark")
+    parser.add_argument("--threshold", type=float, default=0.1,
+        help="relative change reported as slower or faster by --compare (default: 0.1)")
+    args = parser.parse_args(argv)
+    for name in args.passes:
+        if name not in PASSES:
+            parser.error("unknown pass '"+name+"', valid passes: "+", ".join(PASSES))
+    if args.repeat < 1:
+        parser.error("--repeat must be at least 1")
+    if args.pieces < 1:
+        parser.error("--pieces must be at least 1")
+    return args
+
+#converts a comma-separated list of sizes to integers
+#called by parseArgs
+def parseSizes(value):
+    sizes = [int(size) for size in value.split(",")]
+    if min(sizes) < 1:
+        raise argparse.ArgumentTypeError("sizes must be at least 1")
+    return sizes
+
+#returns the git revision of RATTwithGFF.py, or None outside of a git checkout
+#called by main
+def getRevision():
+    try:
+        process = subprocess.Popen(["git", "describe", "--always", "--dirty"], cwd=REPO_DIR,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        revision = process.communicate()[0].strip()
+    except OSError:
+        return None
+    if process.returncode != 0:
+        return None
+    return revision
+
+#builds the gene models of a synthetic genome
+#returns a list of (contig name, contig length, genes), a gene is (strand, exons) and an exon is (start, end)
+#called by main
+def makeGenome(contigs, genesPerContig, exonsPerGene, seed):
+    generator = random.Random(seed)
+    genome = []
+    for c in range(contigs):
+        genes = []
+        position = generator.randint(100, 1000)
+        for g in range(genesPerContig):
+            exons = []
+            for e in range(exonsPerGene):
+                length = generator.randint(60, 400)
+                exons.append((position, position+length-1))
+                position += length + generator.randint(40, 200) #intron
+            genes.append((generator.choice("+-"), exons))
+            position += generator.randint(200, 1000) #intergenic region
+        genome.append(("chr"+str(c+1), position+generator.randint(100, 1000), genes))
+    return genome
+
+#returns the gff lines seqret makes from the RATT embl of a contig
+#split features are written as a 'biological_region' followed by their parts, as seqret does
+#every fifth CDS starts before its mRNA so that fixCdsCoordinates has clamping to do
+#called by benchmarkGenome
+def makeSeqretGff(contig, length, genes):
+    seqid = "run."+contig+".final"
+    lines = ["##gff-version 3\n", "##sequence-region "+seqid+" 1 "+str(length)+"\n"]
+    lines.append(gffLine(seqid, "databank_entry", 1, length, "+", ".", "ID="+seqid+".1;organism=unknown"))
+    count = 1
+    for g in range(len(genes)):
+        strand, exons = genes[g]
+        start = exons[0][0]
+        end = exons[-1][1]
+        geneID = contig+"_gene"+str(g)
+        rnaID = contig+"_rna"+str(g)
+        count += 1
+        lines.append(gffLine(seqid, "gene", start, end, strand, ".",
+            "ID="+seqid+"."+str(count)+";note=ID:"+geneID+";standard_name="+geneID+";locus_tag="+geneID))
+        count += 1
+        lines.extend(splitFeature(seqid, "mRNA", count, exons, strand, ".",
+            "note=ID:"+rnaID+";note=Parent:"+geneID+";product="+LONG_PRODUCT))
+        for e in range(len(exons)):
+            count += 1
+            lines.append(gffLine(seqid, "exon", exons[e][0], exons[e][1], strand, ".",
+                "ID="+seqid+"."+str(count)+";note=ID:"+contig+"_exon"+str(g)+"."+str(e)+";note=Parent:"+rnaID))
+        cds = list(exons)
+        cds[0] = (cds[0][0] + (-3 if g%5 == 0 else 10), cds[0][1])
+        cds[-1] = (cds[-1][0], cds[-1][1]-10)
+        count += 1
+        lines.extend(splitFeature(seqid, "CDS", count, cds, strand, "0",
+            "note=ID:"+contig+"_cds"+str(g)+";note=Parent:"+rnaID+";locus_tag="+geneID+";transl_table=1;codon_start=1"))
+    return lines
+
+#returns the lines seqret writes for a feature, a 'biological_region' and its parts if it has more than one part
+#called by makeSeqretGff
+def splitFeature(seqid, featureType, count, parts, strand, phase, attributes):
+    featureID = seqid+"."+str(count)
+    if len(parts) == 1:
+        return [gffLine(seqid, featureType, parts[0][0], parts[0][1], strand, phase, "ID="+featureID+";"+attributes)]
+    lines = [gffLine(seqid, "biological_region", parts[0][0], parts[-1][1], strand, ".",
+        "ID="+featureID+";featflags=type:"+featureType+";"+attributes)]
+    for start, end in parts:
+        lines.append(gffLine(seqid, featureType, start, end, strand, phase, "Parent="+featureID))
+    return lines
+
+#formats a gff feature line
+#called by makeSeqretGff, splitFeature and makeGenomicGff
+def gffLine(seqid, featureType, start, end, strand, phase, attributes):
+    return "\t".join((seqid, "EMBL", featureType, str(start), str(end), ".", strand, phase, attributes))+"\n"
+
+#returns the text of a contig embl as EMBLmyGFF3 writes it, with locations and qualifiers wrapped at 80 columns
+#called by benchmarkGenome
+def makeWrappedEmbl(contig, length, genes, generator):
+    lines = ["ID   "+contig+"; "+contig+"; linear; genomic DNA; STD; UNC; "+str(length)+" BP.\n", "XX\n",
+        "FH   Key             Location/Qualifiers\n", "FH\n", "FT   source          1.."+str(length)+"\n"]
+    for g in range(len(genes)):
+        strand, exons = genes[g]
+        location = "join("+",".join(str(start)+".."+str(end) for start, end in exons)+")"
+        if strand == "-":
+            location = "complement("+location+")"
+        for key in ("mRNA", "CDS"):
+            lines.extend(wrapEmblLine("FT   "+key.ljust(16)+location))
+            lines.extend(wrapEmblLine("FT                   /note=\"ID:"+contig+"_"+key+str(g)+"\""))
+            lines.extend(wrapEmblLine("FT                   /product=\""+LONG_PRODUCT+"\""))
+    lines.append("SQ   Sequence "+str(length)+" BP;\n")
+    bases = "".join(generator.choice("acgt") for x in range(600))
+    for position in range(0, length, 60):
+        count = min(60, length-position)
+        row = bases[position%540:position%540+count]
+        lines.append("     "+" ".join(row[x:x+10] for x in range(0, count, 10)).ljust(66)+str(position+count).rjust(9)+"\n")
+    lines.append("//\n")
+    return "".join(lines)
+
+#wraps an embl feature line at 80 columns, the wrapped parts are continued after 21 spaces
+#called by makeWrappedEmbl
+def wrapEmblLine(line):
+    lines = [line[:80]+"\n"]
+    for x in range(80, len(line), 59):
+        lines.append("FT                   "+line[x:x+59]+"\n")
+    return lines
+
+#returns the lines of the genomic gff RATTwithGFF.py writes at the end of a transfer
+#called by benchmarkGenome
+def makeGenomicGff(genome):
+    lines = ["##gff-version 3\n"]
+    for contig, length, genes in genome:
+        count = 0
+        for g in range(len(genes)):
+            strand, exons = genes[g]
+            count += 1
+            geneID = contig+"."+str(count)
+            lines.append(gffLine(contig, "gene", exons[0][0], exons[-1][1], strand, ".", "ID="+geneID))
+            count += 1
+            rnaID = contig+"."+str(count)
+            lines.append(gffLine(contig, "mRNA", exons[0][0], exons[-1][1], strand, ".", "ID="+rnaID+";Parent="+geneID))
+            for start, end in exons:
+                count += 1
+                lines.append(gffLine(contig, "exon", start, end, strand, ".", "ID="+contig+"."+str(count)+";Parent="+rnaID))
+            count += 1
+            for start, end in exons:
+                lines.append(gffLine(contig, "CDS", start, end, strand, "0", "ID="+contig+"."+str(count)+";Parent="+rnaID))
+    return lines
+
+#runs a result pass on the features of a contig
+#state holds the features and the index made by indexFeatures
+#called by timeResultPass
+def runResultPass(name, state):
+    if name == "indexFeatures":
+        state["index"] = RATTwithGFF.indexFeatures(state["lines"])
+    elif name in ("addAllParents", "fixCdsCoordinates"):
+        state["lines"] = getattr(RATTwithGFF, name)(state["lines"], state["index"])
+    else:
+        state["lines"] = getattr(RATTwithGFF, name)(state["lines"])
+
+#times a result pass on each contig, after running the passes before it without timing them
+#returns the time of the fastest repeat, summed over the contigs
+#called by benchmarkGenome
+def timeResultPass(name, contigLines, repeat):
+    previous = RESULT_PASSES[:RESULT_PASSES.index(name)]
+    best = None
+    for r in range(repeat):
+        total = 0.0
+        for lines in contigLines:
+            features = []
+            for line in lines:
+                feature = RATTwithGFF.parseGffLine(line)
+                features.append(line if feature is None else feature)
+            state = {"lines":features, "index":None}
+            for passName in previous:
+                runResultPass(passName, state)
+            gc.collect()
+            start = timeit.default_timer()
+            runResultPass(name, state)
+            total += timeit.default_timer() - start
+        if best is None or total < best:
+            best = total
+    return best
+
+#times a pass that works on files, function is called once for each file
+#returns the time of the fastest repeat, summed over the files
+#called by benchmarkGenome
+def timeFilePass(function, fileNames, repeat):
+    best = None
+    for r in range(repeat):
+        total = 0.0
+        for fileName in fileNames:
+            gc.collect()
+            start = timeit.default_timer()
+            function(fileName)
+            total += timeit.default_timer() - start
+        if best is None or total < best:
+            best = total
+    return best
+
+#fixes the broken lines of a wrapped embl like cleanEmbl does
+#called by benchmarkGenome
+def runFixBrokenLines(fileName):
+    with open(fileName+".fixed", "w") as outFile:
+        RATTwithGFF.fixBrokenLines(fileName, outFile)
+
+#appends a result gff to a new genomic gff and counts its features like processRattResults does
+#called by benchmarkGenome
+def runAddToGenomicGff(fileName):
+    with open(fileName) as lines, open(fileName+".genomic", "w") as genomic:
+        genomic.write("##gff-version 3\n")
+        RATTwithGFF.addToGenomicGff(lines, genomic, {})
+
+#times the chosen passes on a synthetic genome
+#returns a result for each pass with the genome size and the time in seconds
+#called by main
+def benchmarkGenome(genome, contigs, genes, exons, passes, repeat, workDir):
+    contigLines = [makeSeqretGff(contig, length, contigGenes) for contig, length, contigGenes in genome]
+    features = sum(1 for lines in contigLines for line in lines if not line.startswith("#"))
+    results = []
+    for name in passes:
+        if name == "fixBrokenLines":
+            generator = random.Random(contigs)
+            fileNames = []
+            for contig, length, contigGenes in genome:
+                fileNames.append(os.path.join(workDir, contig+".embl"))
+                with open(fileNames[-1], "w") as embl:
+                    embl.write(makeWrappedEmbl(contig, length, contigGenes, generator))
+            seconds = timeFilePass(runFixBrokenLines, fileNames, repeat)
+        elif name == "addToGenomicGff":
+            fileName = os.path.join(workDir, "results.final.gff")
+            with open(fileName, "w") as gff:
+                gff.writelines(makeGenomicGff(genome))
+            seconds = timeFilePass(runAddToGenomicGff, [fileName], repeat)
+        else:
+            seconds = timeResultPass(name, contigLines, repeat)
+        results.append({"pass":name, "contigs":contigs, "genesPerContig":genes, "exonsPerGene":exons,
+            "features":features, "seconds":seconds})
+        print "%-22s contigs=%-4d genes=%-6d exons=%-3d %10.4fs" % (name, contigs, genes, exons, seconds)
+        sys.stdout.flush()
+    return results
+
+#cuts the example chromosome into pieces of about the same length, at positions outside of any feature
+#so that every feature is kept whole in one of the pieces; the chromosome-long region feature is left out
+#returns the paths of the reference gff and fasta of the pieces
+#called by benchmarkShards
+def cutExample(pieces, workDir):
+    with open(EXAMPLE_FASTA) as fasta:
+        seqid = fasta.readline()[1:].split()[0]
+        sequence = "".join(line.strip() for line in fasta)
+    features = []
+    with open(EXAMPLE_GFF) as gff:
+        for line in gff:
+            columns = line.rstrip("\n").split("\t")
+            if line.startswith("#") or len(columns) < 9 or columns[2] == "region":
+                continue
+            features.append(columns)
+
+    covered = sorted((int(columns[3]), int(columns[4])) for columns in features)
+    cuts = [0]
+    for piece in range(1, pieces):
+        cut = len(sequence)*piece//pieces
+        for start, end in covered:
+            if start <= cut < end: #moved to the end of the feature, which can run into the next one
+                cut = end
+        if cuts[-1] < cut < len(sequence):
+            cuts.append(cut)
+    cuts.append(len(sequence))
+
+    gffName = os.path.join(workDir, "pieces.gff")
+    fastaName = os.path.join(workDir, "pieces.fa")
+    with open(gffName, "w") as gff, open(fastaName, "w") as fasta:
+        gff.write("##gff-version 3\n")
+        for piece in range(len(cuts)-1):
+            gff.write("##sequence-region %s_%d 1 %d\n" % (seqid, piece+1, cuts[piece+1]-cuts[piece]))
+        for columns in features:
+            piece = bisect.bisect_left(cuts, int(columns[3]))-1
+            offset = cuts[piece]
+            gff.write("\t".join([seqid+"_"+str(piece+1)]+columns[1:3]+[str(int(columns[3])-offset),
+                str(int(columns[4])-offset)]+columns[5:])+"\n")
+        for piece in range(len(cuts)-1):
+            fasta.write(">%s_%d\n" % (seqid, piece+1))
+            for start in range(cuts[piece], cuts[piece+1], 60):
+                fasta.write(sequence[start:min(start+60, cuts[piece+1])]+"\n")
+    return gffName, fastaName
+
+#transfers the example pieces to the example chromosome with each number of RATT shards
+#each run is made in its own directory, without the embl cache, and the fastest of the repeats is reported
+#returns a result for each number of shards with the wall time of RATT and of the whole run and the md5 of the genomic gff
+#called by main
+def benchmarkShards(shardCounts, pieces, rattType, repeat, workDir):
+    gff, fasta = cutExample(pieces, workDir)
+    results = []
+    cwd = os.getcwd()
+    for shards in shardCounts:
+        best = None
+        for run in range(repeat):
+            runDir = os.path.join(workDir, "shards"+str(shards)+"_"+str(run))
+            os.mkdir(runDir)
+            os.chdir(runDir)
+            try:
+                started = timeit.default_timer()
+                result = RATTwithGFF.transfer(gff, fasta, EXAMPLE_FASTA, rattType, "bench", features=False,
+                    rattShards=shards, noCache=True)
+                seconds = timeit.default_timer()-started
+            finally:
+                os.chdir(cwd)
+            if result is None:
+                sys.exit("benchmark.py: the transfer with "+str(shards)+" shards failed")
+            with open(os.path.join(runDir, result["rattDir"], "telemetry.json")) as telemetry:
+                ratt = [record["wall"] for record in json.load(telemetry)["records"]
+                    if record["kind"] == "stage" and record["name"] == "ratt"][0]
+            with open(os.path.join(runDir, result["genomicGff"])) as genomic:
+                md5 = hashlib.md5(genomic.read()).hexdigest()
+            if best is None or ratt < best["rattSeconds"]:
+                best = {"shards":shards, "pieces":pieces, "rattSeconds":ratt, "seconds":seconds, "md5":md5}
+            shutil.rmtree(runDir)
+        results.append(best)
+        print "shards=%-3d ratt %10.2fs total %10.2fs" % (shards, best["rattSeconds"], best["seconds"])
+        sys.stdout.flush()
+    return results
+
+#prints the shard results as a table, the speedup is relative to the first number of shards
+#the genomic gff of every number of shards should be the same as that of the first
+#called by main
+def printShardResults(results):
+    print "\n%8s %12s %12s %8s %8s" % ("shards", "ratt", "total", "speedup", "output")
+    for result in results:
+        print "%8d %11.2fs %11.2fs %7.2fx %8s" % (result["shards"], result["rattSeconds"], result["seconds"],
+            results[0]["rattSeconds"]/result["rattSeconds"], "same" if result["md5"] == results[0]["md5"] else "DIFFERS")
+
+#prints the results as a table
+#called by main
+def printResults(results):
+    print "\n%-22s %8s %8s %6s %10s %10s %12s" % ("pass", "contigs", "genes", "exons", "features", "seconds", "us/feature")
+    for result in sorted(results, key=resultOrder):
+        print "%-22s %8d %8d %6d %10d %10.4f %12.3f" % (result["pass"], result["contigs"], result["genesPerContig"],
+            result["exonsPerGene"], result["features"], result["seconds"], result["seconds"]*1e6/result["features"])
+
+#prints the scaling of each pass between the smallest and the largest genome
+#the exponent is about 1 for a pass that scales linearly with the number of features and 2 for a quadratic one
+#called by main
+def printScaling(results):
+    print "\n%-22s %10s %10s %10s" % ("pass", "features", "time", "exponent")
+    for name in PASSES:
+        runs = sorted((result["features"], result["seconds"]) for result in results if result["pass"] == name)
+        if len(runs) < 2 or runs[0][0] == runs[-1][0] or runs[0][1] <= 0:
+            continue
+        featureRatio = float(runs[-1][0])/runs[0][0]
+        timeRatio = runs[-1][1]/runs[0][1]
+        print "%-22s %9.1fx %9.1fx %10.2f" % (name, featureRatio, timeRatio, math.log(timeRatio)/math.log(featureRatio))
+
+#orders results by pass and genome size
+#called by printResults and compareResults
+def resultOrder(result):
+    return (PASSES.index(result["pass"]) if result["pass"] in PASSES else len(PASSES), result["pass"],
+        result["contigs"], result["genesPerContig"], result["exonsPerGene"])
+
+#compares two result files, the ratio is the new time divided by the old time
+#called by main
+def compareResults(oldFile, newFile, threshold):
+    with open(oldFile) as file:
+        old = json.load(file)
+    with open(newFile) as file:
+        new = json.load(file)
+    print "comparing "+oldFile+" ("+str(old.get("revision"))+") with "+newFile+" ("+str(new.get("revision"))+")"
+    oldResults = dict((resultOrder(result), result) for result in old["results"])
+    print "\n%-22s %8s %8s %6s %10s %10s %8s" % ("pass", "contigs", "genes", "exons", "old", "new", "ratio")
+    for result in sorted(new["results"], key=resultOrder):
+        oldResult = oldResults.get(resultOrder(result))
+        if oldResult is None or oldResult["seconds"] <= 0:
+            continue
+        ratio = result["seconds"]/oldResult["seconds"]
+        change = ""
+        if ratio > 1+threshold:
+            change = "slower"
+        elif ratio < 1-threshold:
+            change = "faster"
+        print "%-22s %8d %8d %6d %10.4f %10.4f %7.2fx %s" % (result["pass"], result["contigs"], result["genesPerContig"],
+            result["exonsPerGene"], oldResult["seconds"], result["seconds"], ratio, change)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python2.7
+
+##############################################################################################################
+# test_fix_broken_lines.py                                                                                   #
+# Function: Checks that the streaming fixBrokenLines of RATTwithGFF.py writes the same bytes as the          #
+#   implementation it replaced, which read the whole embl and joined the wrapped lines walking backwards.    #
+#   The embl fixtures have wrapped locations and qualifiers, qualifiers wrapped over several lines and       #
+#   qualifier text that contains '/'. Runs with pytest or on its own:                                        #
+#   python2.7 tests/test_fix_broken_lines.py                                                                 #
+##############################################################################################################
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+import RATTwithGFF
+
+#fixBrokenLines as it was before it streamed the file, with the helpers it called
+def oldFixBrokenLines(fileName):
+    toRemove = []
+    fixedLines = []
+    with open(fileName) as file:
+        lines = file.readlines()
+        for x in range(len(lines)-1,-1,-1): #starts from last line and moves up ##necessary to fix lines broken into 3+ lines
+            if oldIsBrokenLine(lines[x]):
+                lines[x-1] = oldCombineLines(lines[x-1], lines[x])
+                toRemove.append(x) #keeps track of lines to be removed
+    for i in range(0,len(lines)):
+        if( oldIsInList(i, toRemove) == False):
+            fixedLines.append(lines[i])
+    return fixedLines
+
+def oldIsBrokenLine(line):
+    if (line.find("FT                   ") != -1 and line.find("/") == -1):
+        return True
+    else:
+        return False
+
+def oldCombineLines(line1,line2):
+    first = line1[:line1.find("\n")]
+    second = line2[21:]
+    return (first+second)
+
+def oldIsInList(val,alist):
+    for i in alist:
+        if( i == val ):
+            return True
+    return False
+
+#returns the lines of an FT feature, wrapped at 80 columns as EMBLmyGFF3 wraps them
+def featureLines(key, location, qualifiers):
+    lines = []
+    for first, text in [(key, location)]+[(None, qualifier) for qualifier in qualifiers]:
+        chunks = [text[i:i+59] for i in range(0, len(text), 59)]
+        lines.append(("FT   %-16s" % first if first is not None else "FT"+" "*19)+chunks[0]+"\n")
+        for chunk in chunks[1:]:
+            lines.append("FT"+" "*19+chunk+"\n")
+    return lines
+
+#returns the text of an embl with the given features and a random sequence
+def makeEmbl(features, length, generator):
+    lines = ["ID   XXX; XXX; linear; genomic DNA; STD; UNC; %d BP.\n" % length,
+        "XX\n", "AC   XXX;\n", "XX\n", "FH   Key             Location/Qualifiers\n", "FH\n"]
+    lines.extend(featureLines("source", "1..%d" % length, ['/organism="unknown"', '/mol_type="genomic DNA"']))
+    for feature in features:
+        lines.extend(featureLines(*feature))
+    lines.append("XX\n")
+    lines.append("SQ   Sequence %d BP;\n" % length)
+    sequence = "".join(generator.choice("acgt") for x in range(length))
+    for start in range(0, length, 60):
+        chunk = sequence[start:start+60]
+        lines.append("     %-66s%9d\n" % (" ".join(chunk[i:i+10] for i in range(0, len(chunk), 10)), min(start+60, length)))
+    lines.append("//\n")
+    return "".join(lines)
+
+#features with locations wrapped over three or more lines and long qualifiers
+def wrappedFeatures(generator, genes):
+    features = []
+    position = 100
+    for gene in range(genes):
+        exons = []
+        for exon in range(generator.randint(1, 12)):
+            exons.append("%d..%d" % (position, position+generator.randint(50, 300)))
+            position += 400
+        location = "join("+",".join(exons)+")" if len(exons) > 1 else exons[0]
+        if generator.random() < 0.5:
+            location = "complement("+location+")"
+        features.append(("gene", location.replace("join(", "").replace(")", "").split(",")[0],
+            ['/note="ID:gene%d"' % gene, '/locus_tag="L%05d"' % gene]))
+        features.append(("mRNA", location, ['/note="ID:rna%d"' % gene, '/note="Parent:gene%d"' % gene,
+            '/product="'+" ".join(generator.choice(["hypothetical", "protein", "conserved", "kinase", "domain"])
+                for x in range(generator.randint(1, 40)))+'"']))
+    return features
+
+#qualifiers whose wrapped text contains '/', such lines are not joined by either implementation
+def slashFeatures():
+    return [("CDS", "join(100..200,300..400)", ['/note="ID:cds1"',
+        '/product="NADH/ubiquinone oxidoreductase subunit with a product name long enough to wrap over three lines of the feature table"',
+        '/db_xref="InterPro:IPR000001/IPR000002/IPR000003/IPR000004/IPR000005/IPR000006/IPR000007/IPR000008"']),
+        ("misc_feature", "500..600", ['/note="a note/with a slash near the end of its second line, after which it wraps once more"'])]
+
+#writes each fixture to a file and compares the output of both implementations
+def checkFixture(text):
+    workDir = tempfile.mkdtemp(prefix="rattfix_")
+    try:
+        embl = os.path.join(workDir, "contig_tmp1.embl")
+        with open(embl, "w") as file:
+            file.write(text)
+        with open(os.path.join(workDir, "contig.embl"), "w") as outFile:
+            RATTwithGFF.fixBrokenLines(embl, outFile)
+        with open(os.path.join(workDir, "contig.embl")) as file:
+            new = file.read()
+        old = "".join(oldFixBrokenLines(embl))
+        assert new == old, "fixBrokenLines output differs from the old implementation"
+        return new
+    finally:
+        shutil.rmtree(workDir)
+
+def test_wrapped_locations_and_qualifiers():
+    generator = random.Random(1)
+    fixed = checkFixture(makeEmbl(wrappedFeatures(generator, 200), 100000, generator))
+    assert max(len(line) for line in fixed.split("\n") if line.startswith("FT")) > 200 #lines were joined
+
+def test_qualifiers_with_slashes():
+    generator = random.Random(2)
+    checkFixture(makeEmbl(slashFeatures(), 1000, generator))
+
+def test_wrapped_last_feature_without_sequence():
+    generator = random.Random(3)
+    text = makeEmbl(wrappedFeatures(generator, 3), 2000, generator)
+    checkFixture(text[:text.index("XX\nSQ")]) #the file ends on a wrapped line
+
+def test_unwrapped_embl():
+    generator = random.Random(4)
+    checkFixture(makeEmbl([("gene", "10..20", ['/note="ID:gene1"'])], 100, generator))
+
+if __name__ == "__main__":
+    for name, test in sorted(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print name+" passed"
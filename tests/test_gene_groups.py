@@ -0,0 +1,103 @@
+#!/usr/bin/env python2.7
+
+##############################################################################################################
+# test_gene_groups.py                                                                                        #
+# Function: Checks that fixGeneGroups of RATTwithGFF.py links each feature of a RATT embl to its parent when #
+#   the parent is in another gene group, as in a gff that lists all genes before their mRNAs and CDS, and    #
+#   that the order of the features does not change the Parent attributes or the CDS coordinates it writes.   #
+#   Runs with pytest or on its own:                                                                          #
+#   python2.7 tests/test_gene_groups.py                                                                      #
+##############################################################################################################
+
+import os
+import shutil
+import StringIO
+import sys
+import tempfile
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+import RATTwithGFF
+
+#genes with an mRNA and a CDS in two parts each, the CDS reaches past the end of its mRNA
+def geneFeatures(genes):
+    features = []
+    for gene in range(genes):
+        start = 100+gene*1000
+        features.append(("gene", "%d..%d" % (start, start+600), ['/note="ID:gene%d"' % gene]))
+        features.append(("mRNA", "join(%d..%d,%d..%d)" % (start, start+200, start+400, start+600),
+            ['/note="ID:rna%d"' % gene, '/note="Parent:gene%d"' % gene]))
+        features.append(("CDS", "join(%d..%d,%d..%d)" % (start+50, start+200, start+400, start+650),
+            ['/note="ID:cds%d"' % gene, '/note="Parent:rna%d"' % gene, '/product="protein %d"' % gene]))
+    return features
+
+#returns the text of a RATT embl with the given features, without sequence
+def makeEmbl(features):
+    lines = ["ID   XXX; XXX; linear; genomic DNA; STD; UNC; 10000 BP.\n", "XX\n",
+        "FH   Key             Location/Qualifiers\n", "FH\n", "FT   source          1..10000\n"]
+    for key, location, qualifiers in features:
+        lines.append("FT   %-16s%s\n" % (key, location))
+        for qualifier in qualifiers:
+            lines.append("FT"+" "*19+qualifier+"\n")
+    lines.append("//\n")
+    return "".join(lines)
+
+#fixes the gene groups of an embl with the given features and returns the features written, keyed by their
+#original ID, with the original IDs of their parents
+def fixEmbl(features):
+    workDir = tempfile.mkdtemp(prefix="rattgroups_")
+    try:
+        embl = os.path.join(workDir, "contig.embl")
+        with open(embl, "w") as file:
+            file.write(makeEmbl(features))
+        outFile = StringIO.StringIO()
+        links = RATTwithGFF.newGroupLinks(RATTwithGFF.emblParentIDs(embl))
+        RATTwithGFF.fixGeneGroups(RATTwithGFF.readEmbl(embl, "contig"), None, outFile, links)
+    finally:
+        shutil.rmtree(workDir)
+    originals = {}
+    rows = []
+    for line in outFile.getvalue().splitlines():
+        if line.startswith("##FASTA"):
+            break
+        if line.startswith("#"):
+            continue
+        fields = line.split("\t")
+        attributes = dict(x.split("=", 1) for x in fields[8].split(";") if not x.startswith("note="))
+        noteID = [x[8:] for x in fields[8].split(";") if x.startswith("note=ID:")][0]
+        originals[attributes["ID"]] = noteID
+        rows.append((noteID, fields[2], int(fields[3]), int(fields[4]), fields[7], attributes.get("Parent")))
+    written = {}
+    for noteID, type, start, end, phase, parent in rows:
+        parents = None if parent is None else ",".join(originals[x] for x in parent.split(","))
+        written.setdefault(noteID, []).append((type, start, end, phase, parents))
+    return written
+
+def test_type_ordered_features():
+    features = geneFeatures(5)
+    byType = sorted(features, key=lambda x: ["gene", "mRNA", "CDS"].index(x[0]))
+    written = fixEmbl(byType)
+    assert written == fixEmbl(features), "the order of the features changed the gff"
+    for gene in range(5):
+        assert written["rna%d" % gene][0][4] == "gene%d" % gene
+        assert [x[4] for x in written["cds%d" % gene]] == ["rna%d" % gene]*2
+        assert written["cds%d" % gene][1][2] == 100+gene*1000+600 #clamped to the end of the mRNA
+
+def test_children_before_parents():
+    features = geneFeatures(3)
+    written = fixEmbl(features[::-1])
+    for gene in range(3):
+        assert written["rna%d" % gene][0][4] == "gene%d" % gene
+        assert [x[4] for x in written["cds%d" % gene]] == ["rna%d" % gene]*2
+
+def test_parent_not_in_contig():
+    features = geneFeatures(2)
+    features.append(("exon", "5000..5100", ['/note="ID:exon1"', '/note="Parent:missing"']))
+    written = fixEmbl(features)
+    assert written["exon1"] == [("exon", 5000, 5100, ".", None)]
+
+if __name__ == "__main__":
+    for name, test in sorted(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print name+" passed"